@@ -0,0 +1,162 @@
+# Copyright 2015 The Ostrich / by Itamar O
+
+"""Generate a synthetic large project for build-system benchmarks.
+
+usage: python benchmarks/generate_project.py OUTPUT_DIR [OPTIONS]
+
+The generated project uses this repository's SConstruct and site_scons
+(copied into OUTPUT_DIR), with a stub toolchain (see stub_tool.py), and
+modules written in the same SConscript idiom as the example modules:
+every module has protos (importing the previous proto in the module, and
+a proto of a dependency module), a library (with `with_libs` fan-out to
+earlier modules), and some modules have programs.
+"""
+
+import optparse
+import os
+import random
+import shutil
+import sys
+
+_REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         os.pardir)
+
+_STUB_CONFIG = '''
+# Stub toolchain for benchmarks (appended by benchmarks/generate_project.py)
+_STUB_TOOL = '"%(python)s" "%(stub)s"'
+ENV_OVERRIDES['_common'].update(
+    CC      = _STUB_TOOL + ' cc',
+    CXX     = _STUB_TOOL + ' cc',
+    AR      = _STUB_TOOL + ' ar',
+    RANLIB  = _STUB_TOOL + ' ranlib',
+    PROTOC  = _STUB_TOOL + ' protoc',
+    # The stub compiler doesn't preprocess, so objects can't be cached
+    OBJCACHE_DIR = '',
+    OBJCACHE_URL = '',
+)
+'''
+
+def module_path(idx, depth):
+    """Return path of module number `idx`, nested `depth` levels deep."""
+    groups = ['g%d' % ((idx // (10 ** level)) % 10)
+              for level in xrange(depth - 1, 0, -1)]
+    return os.path.join(*(groups + ['m%d' % (idx)]))
+
+def write_file(path, content):
+    """Write content to path, creating parent directories as needed."""
+    parent = os.path.dirname(path)
+    if parent and not os.path.isdir(parent):
+        os.makedirs(parent)
+    with open(path, 'w') as out_file:
+        out_file.write(content)
+
+def copy_build_system(out_dir):
+    """Copy SConstruct and site_scons into `out_dir`, with stub toolchain."""
+    shutil.copy(os.path.join(_REPO_DIR, 'SConstruct'), out_dir)
+    shutil.copytree(os.path.join(_REPO_DIR, 'site_scons'),
+                    os.path.join(out_dir, 'site_scons'),
+                    ignore=shutil.ignore_patterns('*.pyc'))
+    # Hidden dirs are skipped by module discovery
+    stub_path = os.path.join(out_dir, '.bench', 'stub_tool.py')
+    write_file(stub_path, open(os.path.join(os.path.dirname(
+        os.path.abspath(__file__)), 'stub_tool.py')).read())
+    with open(os.path.join(out_dir, 'site_scons', 'site_config.py'),
+              'a') as config_file:
+        config_file.write(_STUB_CONFIG % dict(
+            python=sys.executable, stub=os.path.abspath(stub_path)))
+
+def generate_module(out_dir, idx, opts, rand):
+    """Generate module number `idx` (depending on earlier modules)."""
+    mod_path = module_path(idx, opts.depth)
+    mod_dir = os.path.join(out_dir, mod_path)
+    deps = sorted(set(rand.sample(xrange(idx), min(idx, opts.fanout))))
+    # Protos - each imports the previous one, and the first imports
+    #  the first proto of the first dependency
+    protos = list()
+    for proto_idx in xrange(opts.protos):
+        proto_name = 'm%d_p%d' % (idx, proto_idx)
+        if proto_idx > 0:
+            imports = [os.path.join(mod_path, protos[-1])]
+        elif deps:
+            imports = [os.path.join(module_path(deps[0], opts.depth),
+                                    'm%d_p0' % (deps[0]))]
+        else:
+            imports = []
+        write_file(os.path.join(mod_dir, proto_name + '.proto'), ''.join(
+            ['syntax = "proto2";\n'] +
+            ['import "%s.proto";\n' % (imp) for imp in imports] +
+            ['message M%dP%d {\n  optional int32 x = 1;\n}\n' %
+             (idx, proto_idx)]))
+        protos.append(proto_name)
+    # Library sources - each includes its header, a generated header of the
+    #  module and the header of every dependency module library
+    sources = list()
+    for src_idx in xrange(opts.sources):
+        src_name = 'm%d_s%d' % (idx, src_idx)
+        includes = ['%s.h' % (os.path.join(mod_path, src_name))]
+        if protos:
+            includes.append('%s.pb.h' % (os.path.join(mod_path, protos[-1])))
+        includes.extend('%s.h' % (os.path.join(module_path(dep, opts.depth),
+                                                'm%d_s0' % (dep)))
+                        for dep in deps)
+        write_file(os.path.join(mod_dir, src_name + '.h'),
+                   'int %s();\n' % (src_name))
+        write_file(os.path.join(mod_dir, src_name + '.cc'), ''.join(
+            ['#include "%s"\n' % (inc) for inc in includes] +
+            ['int %s() { return %d; }\n' % (src_name, src_idx)]))
+        sources.append(src_name + '.cc')
+    sconscript = ['# Generated benchmark module %s\n\n' % (mod_path)]
+    for proto_name in protos:
+        sconscript.append("Protoc([], '%s.proto',\n"
+                          "       PROTOPATH=['$BUILDROOT'], "
+                          "PROTOCPPOUT='$BUILDROOT')\n" % (proto_name))
+    lib_sources = sources + ['%s.pb.cc' % (proto) for proto in protos]
+    sconscript.append('Lib(%r, %r,\n    with_libs=%r)\n' % (
+        'm%d' % (idx), lib_sources, ['m%d' % (dep) for dep in deps]))
+    if opts.prog_every and idx % opts.prog_every == 0:
+        write_file(os.path.join(mod_dir, 'main.cc'),
+                   '#include "%s.h"\nint main() { return 0; }\n' %
+                   (os.path.join(mod_path, 'm%d_s0' % (idx))))
+        sconscript.append("Prog('prog', 'main.cc', with_libs='m%d')\n" %
+                          (idx))
+    write_file(os.path.join(mod_dir, 'SConscript'), ''.join(sconscript))
+
+def generate_project(out_dir, opts):
+    """Generate benchmark project in `out_dir` according to `opts`."""
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.makedirs(out_dir)
+    copy_build_system(out_dir)
+    rand = random.Random(opts.seed)
+    for idx in xrange(opts.modules):
+        generate_module(out_dir, idx, opts, rand)
+
+def add_options(parser):
+    """Add project generation options to optparse `parser`."""
+    parser.add_option('--modules', type='int', default=200,
+                      help='Number of modules [%default]')
+    parser.add_option('--depth', type='int', default=3,
+                      help='Nesting depth of module dirs [%default]')
+    parser.add_option('--protos', type='int', default=2,
+                      help='Protos per module (import chain) [%default]')
+    parser.add_option('--sources', type='int', default=4,
+                      help='C++ sources per module library [%default]')
+    parser.add_option('--fanout', type='int', default=3,
+                      help='Library dependencies per module [%default]')
+    parser.add_option('--prog-every', type='int', default=10,
+                      help='Add a program every N modules [%default]')
+    parser.add_option('--seed', type='int', default=37,
+                      help='Random seed for dependencies [%default]')
+
+def main():
+    """Parse command line and generate the project."""
+    parser = optparse.OptionParser(
+        usage='usage: %prog OUTPUT_DIR [options]')
+    add_options(parser)
+    opts, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('Missing OUTPUT_DIR')
+    generate_project(args[0], opts)
+
+if '__main__' == __name__:
+    main()
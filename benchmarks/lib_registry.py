@@ -0,0 +1,85 @@
+# Copyright 2015 The Ostrich / by Itamar O
+
+"""Benchmark library resolution for programs, scaling up to 10k libraries.
+
+usage: python benchmarks/lib_registry.py [MAX_LIBS]
+
+For every library count, registers libraries in 5 layers (each library
+depends on 3 libraries from the previous layer), creates one program per
+library (linking with 3 short-name queries), and measures:
+  - linear scan resolution (the previous `endswith` scan over every key)
+  - LibraryRegistry resolution of the transitive closure in link order
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'site_scons'))
+
+from site_utils import LibraryRegistry  # pylint: disable=import-error
+
+_NUM_LAYERS = 5
+_FANOUT = 3
+
+def lib_name(idx):
+    """Return short name of library number `idx`."""
+    return 'lib%d' % (idx)
+
+def lib_deps(idx, layer_size):
+    """Return short names of libraries that library `idx` depends on."""
+    layer_start = (idx // layer_size - 1) * layer_size
+    if layer_start < 0:
+        return []
+    return [lib_name(layer_start + (idx + offset) % layer_size)
+            for offset in xrange(_FANOUT)]
+
+def prog_deps(prog_idx, num_libs):
+    """Return short names of libraries that program `prog_idx` links with."""
+    return [lib_name((prog_idx + offset) % num_libs)
+            for offset in xrange(_FANOUT)]
+
+def linear_scan(libs, lib_query):
+    """Resolve short name query by scanning every library key."""
+    suffix = '::%s' % (lib_query)
+    return [lib_key for lib_key in libs if lib_key.endswith(suffix)]
+
+def bench_linear(num_libs):
+    """Return seconds to resolve direct `with_libs` of all programs
+    (without transitive dependencies, which weren't supported).
+    """
+    libs = dict(('Module%d::%s' % (idx, lib_name(idx)), [idx])
+                for idx in xrange(num_libs))
+    start = time.time()
+    for prog_idx in xrange(num_libs):
+        for lib_query in prog_deps(prog_idx, num_libs):
+            assert len(linear_scan(libs, lib_query)) == 1
+    return time.time() - start
+
+def bench_registry(num_libs):
+    """Return seconds to register libraries and resolve all programs
+    (including transitive dependencies).
+    """
+    start = time.time()
+    layer_size = num_libs // _NUM_LAYERS
+    registry = LibraryRegistry()
+    for idx in xrange(num_libs):
+        registry.add('Module%d::%s' % (idx, lib_name(idx)), [idx],
+                     lib_deps(idx, layer_size))
+    for prog_idx in xrange(num_libs):
+        registry.link_order(prog_deps(prog_idx, num_libs))
+    return time.time() - start
+
+def main():
+    """Run the benchmark and print the results."""
+    max_libs = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    num_libs = 100
+    print '%8s %14s %14s' % ('libs', 'linear (sec)', 'registry (sec)')
+    while num_libs <= max_libs:
+        print '%8d %14.3f %14.3f' % (num_libs, bench_linear(num_libs),
+                                     bench_registry(num_libs))
+        num_libs *= 10
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,190 @@
+# Copyright 2015 The Ostrich / by Itamar O
+
+"""Benchmark edit-relink latency of debug builds by link strategy.
+
+usage: python benchmarks/link_latency.py [options]
+
+Generates a debug-built program in a temp dir, linking with `--libs`
+static libraries of `--sources` C++ sources each, and for the default link
+settings and every strategy in site_config.LINK_STRATEGIES (translated to
+the flags that site_tools/linkstrategy.py uses), measures:
+  - full build time (compile, archive, link)
+  - edit-relink time: after editing one library source, recompile it,
+    re-archive its library and relink the program (best of `--repeat`)
+"""
+
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'site_scons'))
+
+from site_config import LINK_STRATEGIES  # pylint: disable=import-error
+
+_SOURCE_TEMPLATE = """\
+#include <map>
+#include <string>
+#include <vector>
+
+namespace lib%(lib)d {
+
+struct Record%(idx)d {
+  std::string name;
+  std::map<std::string, std::vector<long> > values;
+};
+
+long compute%(idx)d(const std::vector<std::string>& keys, int edit) {
+  std::map<std::string, Record%(idx)d> records;
+  for (size_t i = 0; i < keys.size(); ++i) {
+    records[keys[i]].values[keys[i]].push_back(i + edit);
+  }
+  return records.size() + %(edit)d;
+}
+
+}  // namespace lib%(lib)d
+"""
+
+def _which(program):
+    """Return True if program is found in PATH."""
+    return any(os.access(os.path.join(path_dir, program), os.X_OK)
+               for path_dir in os.environ.get('PATH', '').split(os.pathsep))
+
+def strategy_flags(strategy):
+    """Return (archive flags, compile flags, link flags) of strategy."""
+    ar_flags = 'rcT' if strategy.get('THIN_ARCHIVES') else 'rc'
+    cc_flags = ['-g'] + (['-gsplit-dwarf'] if strategy.get('SPLIT_DWARF')
+                         else [])
+    link_flags = list()
+    for linker in strategy.get('LINKERS', []):
+        if _which('ld.%s' % (linker)):
+            link_flags.append('-fuse-ld=%s' % (linker))
+            if strategy.get('GDB_INDEX'):
+                link_flags.append('-Wl,--gdb-index')
+            break
+    return ar_flags, cc_flags, link_flags
+
+def write_source(path, lib_idx, idx, edit=0):
+    """Write library source (with `edit` making it different)."""
+    with open(path, 'w') as src_file:
+        src_file.write(_SOURCE_TEMPLATE % dict(lib=lib_idx, idx=idx,
+                                               edit=edit))
+
+class Project(object):
+    """Generated program with static libraries, built with given flags."""
+
+    def __init__(self, root, num_libs, num_sources, cxx, flags):
+        self.root = root
+        self.cxx = cxx
+        self.ar_flags, self.cc_flags, self.link_flags = flags
+        self.libs = list()
+        for lib_idx in xrange(num_libs):
+            sources = list()
+            for idx in xrange(num_sources):
+                path = os.path.join(root, 'lib%d_%d.cc' % (lib_idx, idx))
+                write_source(path, lib_idx, idx)
+                sources.append(path)
+            self.libs.append(sources)
+        # The program calls every library function, so it links every object
+        self.main = os.path.join(root, 'main.cc')
+        with open(self.main, 'w') as main_file:
+            main_file.write('#include <string>\n#include <vector>\n')
+            for lib_idx in xrange(num_libs):
+                for idx in xrange(num_sources):
+                    main_file.write(
+                        'namespace lib%d { long compute%d('
+                        'const std::vector<std::string>&, int); }\n' % (
+                            lib_idx, idx))
+            main_file.write('int main() {\n  std::vector<std::string> keys;\n'
+                            '  long sum = 0;\n')
+            for lib_idx in xrange(num_libs):
+                for idx in xrange(num_sources):
+                    main_file.write('  sum += lib%d::compute%d(keys, 0);\n' %
+                                    (lib_idx, idx))
+            main_file.write('  return sum > 0 ? 0 : 1;\n}\n')
+
+    def _run(self, cmd):
+        """Run command in project root."""
+        subprocess.check_call(cmd, cwd=self.root)
+
+    def compile(self, source):
+        """Compile source, return object path."""
+        obj = os.path.splitext(source)[0] + '.o'
+        self._run([self.cxx, '-c', source, '-o', obj] + self.cc_flags)
+        return obj
+
+    def archive(self, lib_idx):
+        """Archive library objects, return archive path."""
+        lib = os.path.join(self.root, 'liblib%d.a' % (lib_idx))
+        if os.path.exists(lib):
+            os.remove(lib)
+        objects = [os.path.splitext(src)[0] + '.o'
+                   for src in self.libs[lib_idx]]
+        self._run(['ar', self.ar_flags, lib] + objects)
+        self._run(['ranlib', lib])
+        return lib
+
+    def link(self):
+        """Link the program with all libraries."""
+        libs = [os.path.join(self.root, 'liblib%d.a' % (lib_idx))
+                for lib_idx in xrange(len(self.libs))]
+        self._run([self.cxx, '-o', os.path.join(self.root, 'prog'),
+                   os.path.splitext(self.main)[0] + '.o'] + libs +
+                  self.link_flags)
+
+    def build(self):
+        """Build everything, return build time in seconds."""
+        start = time.time()
+        for lib_idx, sources in enumerate(self.libs):
+            for source in sources:
+                self.compile(source)
+            self.archive(lib_idx)
+        self.compile(self.main)
+        self.link()
+        return time.time() - start
+
+    def edit_relink(self, edit):
+        """Edit one source, rebuild what depends on it, return seconds."""
+        write_source(self.libs[0][0], 0, 0, edit)
+        start = time.time()
+        self.compile(self.libs[0][0])
+        self.archive(0)
+        self.link()
+        return time.time() - start
+
+def main():
+    """Run the benchmark and print the results."""
+    parser = optparse.OptionParser(usage='usage: %prog [options]')
+    parser.add_option('--libs', type='int', default=8,
+                      help='Number of libraries [%default]')
+    parser.add_option('--sources', type='int', default=8,
+                      help='Number of sources per library [%default]')
+    parser.add_option('--repeat', type='int', default=3,
+                      help='Number of edit-relink repetitions [%default]')
+    parser.add_option('--cxx', default=os.environ.get('CXX', 'c++'),
+                      help='C++ compiler [%default]')
+    opts, _ = parser.parse_args()
+    strategies = [('default', dict())] + sorted(LINK_STRATEGIES.iteritems())
+    print '%-10s %-48s %12s %18s' % ('strategy', 'flags', 'build (sec)',
+                                     'edit-relink (sec)')
+    for name, strategy in strategies:
+        flags = strategy_flags(strategy)
+        work_dir = tempfile.mkdtemp(prefix='link_latency.')
+        try:
+            project = Project(work_dir, opts.libs, opts.sources, opts.cxx,
+                              flags)
+            build_time = project.build()
+            relink_time = min(project.edit_relink(edit)
+                              for edit in xrange(1, opts.repeat + 1))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        print '%-10s %-48s %12.3f %18.3f' % (
+            name, ' '.join([flags[0]] + flags[1][1:] + flags[2]) or '-',
+            build_time, relink_time)
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,96 @@
+# Copyright 2015 The Ostrich / by Itamar O
+
+"""Benchmark cold and warm module discovery on a large synthetic tree.
+
+usage: python benchmarks/module_discovery.py [FANOUT] [DEPTH]
+
+Creates a synthetic tree with FANOUT sub-directories per directory, DEPTH
+levels deep (a SConscript file in every leaf directory), and measures:
+  - plain os.walk-based discovery (no index)
+  - cold indexed discovery (no index file yet)
+  - warm indexed discovery (nothing changed since last run)
+  - warm indexed discovery after adding a module somewhere deep
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'site_scons'))
+
+from site_utils import module_dirs_generator  # pylint: disable=import-error
+
+def make_tree(base_dir, fanout, depth):
+    """Create synthetic tree under `base_dir`, return number of dirs."""
+    count = 0
+    level = ['']
+    for cur_depth in xrange(depth):
+        next_level = list()
+        for parent in level:
+            for idx in xrange(fanout):
+                rel_path = os.path.join(parent, 'd%d' % (idx))
+                os.mkdir(os.path.join(base_dir, rel_path))
+                # Every directory has some source files in it
+                for src_name in ('a.cc', 'b.cc', 'c.h'):
+                    open(os.path.join(base_dir, rel_path, src_name),
+                         'w').close()
+                if cur_depth == depth - 1:
+                    open(os.path.join(base_dir, rel_path, 'SConscript'),
+                         'w').close()
+                next_level.append(rel_path)
+                count += 1
+        level = next_level
+    return count
+
+def backdate_tree(base_dir, seconds=60):
+    """Set mtimes of every directory under `base_dir` `seconds` back.
+
+    The module index doesn't trust directory mtimes from the last couple
+     of seconds (racy mtimes), so a tree created right before indexing
+     would be walked again on the warm run.
+    """
+    mtime = time.time() - seconds
+    for dirpath, _, _ in os.walk(base_dir):
+        os.utime(dirpath, (mtime, mtime))
+
+def timed_discovery(**kwargs):
+    """Return (seconds, number of modules) for one discovery run."""
+    start = time.time()
+    found = list(module_dirs_generator(max_depth=7, **kwargs))
+    return time.time() - start, len(found)
+
+def main():
+    """Run the benchmark and print the results."""
+    fanout = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    depth = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    base_dir = tempfile.mkdtemp(prefix='module_discovery.')
+    orig_dir = os.getcwd()
+    try:
+        num_dirs = make_tree(base_dir, fanout, depth)
+        backdate_tree(base_dir)
+        os.chdir(base_dir)
+        index_path = os.path.join(base_dir, '.modules_index')
+        print 'Synthetic tree: %d directories' % (num_dirs)
+        results = [
+            ('os.walk', timed_discovery()),
+            ('cold index', timed_discovery(index_path=index_path)),
+            ('warm index', timed_discovery(index_path=index_path)),
+        ]
+        # Add a new module deep in the tree and discover again
+        new_module = os.path.join(*(['d0'] * depth + ['new']))
+        os.mkdir(new_module)
+        open(os.path.join(new_module, 'SConscript'), 'w').close()
+        results.append(('warm index (1 new module)',
+                        timed_discovery(index_path=index_path)))
+        for name, (seconds, num_modules) in results:
+            print '%-28s %8.3f sec  (%d modules)' % (name, seconds,
+                                                    num_modules)
+    finally:
+        os.chdir(orig_dir)
+        shutil.rmtree(base_dir)
+
+if '__main__' == __name__:
+    main()
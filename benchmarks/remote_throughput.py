@@ -0,0 +1,155 @@
+# Copyright 2015 The Ostrich / by Itamar O
+
+"""Benchmark compile throughput of the remote executor against plain `-j`.
+
+usage: python benchmarks/remote_throughput.py [options]
+
+Generates C++ sources in a temp dir, and compiles all of them `--jobs` at a
+time (like `scons -j`):
+  - locally (plain compiler commands)
+  - through the remote executor (site_scons/remote_exec.py run), with a
+    pool of `--workers` local worker processes
+  - through the remote executor with no reachable worker (local fallback
+    overhead)
+On one box, the remote executor can't beat plain `-j` (it adds local
+preprocessing and transfer), so this measures its overhead; with workers
+on other machines, `--jobs` can exceed the local core count.
+"""
+
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+_SITE_SCONS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           os.pardir, 'site_scons')
+sys.path.insert(0, _SITE_SCONS)
+
+from remote_exec import start_pool  # pylint: disable=import-error
+
+_SOURCE_TEMPLATE = """\
+#include <map>
+#include <string>
+#include <vector>
+
+namespace bench%(idx)d {
+
+template <int N> struct Fib {
+  static const long value = Fib<N - 1>::value + Fib<N - 2>::value;
+};
+template <> struct Fib<0> { static const long value = 0; };
+template <> struct Fib<1> { static const long value = 1; };
+
+long compute(const std::vector<std::string>& keys) {
+  std::map<std::string, long> values;
+  for (size_t i = 0; i < keys.size(); ++i) {
+    values[keys[i]] += Fib<%(depth)d>::value + i;
+  }
+  long sum = 0;
+  for (std::map<std::string, long>::const_iterator it = values.begin();
+       it != values.end(); ++it) {
+    sum += it->second;
+  }
+  return sum;
+}
+
+}  // namespace bench%(idx)d
+"""
+
+def generate_sources(src_dir, num_sources):
+    """Write benchmark sources, return list of source paths (relative)."""
+    sources = list()
+    for idx in xrange(num_sources):
+        path = os.path.join(src_dir, 'bench%d.cc' % (idx))
+        with open(path, 'w') as src_file:
+            src_file.write(_SOURCE_TEMPLATE % dict(idx=idx,
+                                                   depth=20 + idx % 20))
+        sources.append(os.path.basename(path))
+    return sources
+
+def compile_all(commands, jobs, cwd):
+    """Run commands `jobs` at a time in cwd, return wall time in seconds."""
+    pending = list(reversed(commands))
+    lock = threading.Lock()
+    failures = list()
+    def worker():
+        """Run pending commands until none are left."""
+        while True:
+            with lock:
+                if not pending:
+                    return
+                cmd = pending.pop()
+            if subprocess.call(cmd, cwd=cwd):
+                failures.append(cmd)
+    start = time.time()
+    threads = [threading.Thread(target=worker) for _ in xrange(jobs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if failures:
+        raise RuntimeError('Failed compiling: %s' % (' '.join(failures[0])))
+    return time.time() - start
+
+def compile_commands(sources, cxx, wrapper=None):
+    """Return compile commands for sources (optionally wrapped)."""
+    commands = list()
+    for source in sources:
+        cmd = [cxx, '-O2', '-c', source, '-o', source + '.o', '-MMD', '-MF',
+               source + '.o.d']
+        commands.append((wrapper or []) + cmd)
+    return commands
+
+def main():
+    """Run the benchmark and print the results."""
+    parser = optparse.OptionParser(usage='usage: %prog [options]')
+    parser.add_option('--sources', type='int', default=64,
+                      help='Number of sources to compile [%default]')
+    parser.add_option('--jobs', type='int', default=8,
+                      help='Parallel compile jobs [%default]')
+    parser.add_option('--workers', type='int', default=4,
+                      help='Number of local worker processes [%default]')
+    parser.add_option('--worker-jobs', type='int', default=2,
+                      help='Parallel jobs per worker [%default]')
+    parser.add_option('--base-port', type='int', default=18378,
+                      help='Port of the first worker [%default]')
+    parser.add_option('--cxx', default=os.environ.get('CXX', 'c++'),
+                      help='C++ compiler [%default]')
+    opts, _ = parser.parse_args()
+    work_dir = tempfile.mkdtemp(prefix='remote_throughput.')
+    procs = list()
+    try:
+        src_dir = os.path.join(work_dir, 'src')
+        os.makedirs(src_dir)
+        sources = generate_sources(src_dir, opts.sources)
+        procs, workers = start_pool(opts.workers, opts.base_port,
+                                    opts.worker_jobs,
+                                    os.path.join(work_dir, 'workers'))
+        run_cmd = [sys.executable, os.path.join(_SITE_SCONS,
+                                                'remote_exec.py'), 'run']
+        runs = [
+            ('local -j%d' % (opts.jobs), None),
+            ('remote (%d workers x %d jobs) -j%d' % (
+                opts.workers, opts.worker_jobs, opts.jobs),
+             run_cmd + ['--workers=%s' % (','.join(workers)), '--']),
+            ('remote fallback (no workers) -j%d' % (opts.jobs),
+             run_cmd + ['--workers=127.0.0.1:1', '--']),
+        ]
+        print '%-40s %10s %12s' % ('mode', 'wall (sec)', 'objects/sec')
+        for title, wrapper in runs:
+            wall_time = compile_all(
+                compile_commands(sources, opts.cxx, wrapper), opts.jobs,
+                src_dir)
+            print '%-40s %10.3f %12.2f' % (title, wall_time,
+                                          len(sources) / wall_time)
+    finally:
+        for proc in procs:
+            proc.terminate()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if '__main__' == __name__:
+    main()
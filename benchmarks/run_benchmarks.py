@@ -0,0 +1,120 @@
+# Copyright 2015 The Ostrich / by Itamar O
+
+"""Run build-system benchmarks on a generated synthetic project.
+
+usage: python benchmarks/run_benchmarks.py [OPTIONS]
+
+Generates a project (see generate_project.py) and measures, for every flavor:
+  - module discovery (cold and warm `site_config.py modules`)
+  - SConscript read time (from a `--profile-build` trace of a dry run)
+  - full build, null build, and rebuild after touching one source file
+Results are written as JSON (for regression tracking) and printed.
+"""
+
+import json
+import optparse
+import os
+import platform
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import generate_project
+from module_discovery import backdate_tree
+
+def run_timed(cmd, cwd, env=None):
+    """Run command (list) in `cwd`, return wall time in seconds."""
+    start_time = time.time()
+    with open(os.devnull, 'w') as devnull:
+        proc = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=devnull,
+                                stderr=subprocess.PIPE)
+        _, stderr = proc.communicate()
+    if proc.returncode:
+        sys.exit('Command failed (%d): %s\n%s' % (proc.returncode,
+                                                   ' '.join(cmd), stderr))
+    return time.time() - start_time
+
+def profile_categories(trace_path):
+    """Return dictionary of total seconds per category in a trace file."""
+    with open(trace_path) as trace_file:
+        events = json.load(trace_file)['traceEvents']
+    totals = defaultdict(float)
+    for event in events:
+        if 'X' == event.get('ph'):
+            totals[event['cat']] += event['dur'] / 1e6
+    return dict(totals)
+
+def touch_source(project_dir, depth):
+    """Modify the content of one library source file (of the first module)."""
+    src_path = os.path.join(project_dir, generate_project.module_path(
+        0, depth), 'm0_s0.cc')
+    with open(src_path, 'a') as src_file:
+        src_file.write('// touched %f\n' % (time.time()))
+
+def run_benchmarks(project_dir, opts):
+    """Run all benchmark scenarios, return results dictionary."""
+    scons = shlex.split(opts.scons)
+    jobs = ['-j', str(opts.jobs)]
+    results = dict()
+    config_script = os.path.join('site_scons', 'site_config.py')
+    index_path = os.path.join(project_dir, 'build', '.modules_index')
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    # Make the warm run measure the index, not the racy mtimes re-walk
+    backdate_tree(project_dir)
+    results['discovery_cold'] = run_timed(
+        [sys.executable, config_script, 'modules'], project_dir)
+    results['discovery_warm'] = run_timed(
+        [sys.executable, config_script, 'modules'], project_dir)
+    trace_path = os.path.join(project_dir, 'read_profile.json')
+    results['dry_run'] = run_timed(
+        scons + ['-n', '-Q', '--profile-build=%s' % (trace_path)],
+        project_dir)
+    results['dry_run_profile'] = profile_categories(trace_path)
+    for flavor in opts.flavors.split(','):
+        flavor_results = results[flavor] = dict()
+        flavor_results['full_build'] = run_timed(scons + jobs + [flavor],
+                                                 project_dir)
+        flavor_results['null_build'] = run_timed(scons + jobs + [flavor],
+                                                 project_dir)
+        touch_source(project_dir, opts.depth)
+        flavor_results['touch_rebuild'] = run_timed(scons + jobs + [flavor],
+                                                    project_dir)
+    return results
+
+def main():
+    """Parse command line, generate project, run benchmarks."""
+    parser = optparse.OptionParser()
+    generate_project.add_options(parser)
+    parser.add_option('--project-dir', default=None,
+                      help='Where to generate the project [temp dir]')
+    parser.add_option('--scons', default='scons',
+                      help='Command to run SCons [%default]')
+    parser.add_option('--jobs', type='int', default=8,
+                      help='SCons parallel jobs [%default]')
+    parser.add_option('--flavors', default='debug,release',
+                      help='Comma-separated flavors to build [%default]')
+    parser.add_option('--output', default='bench_results.json',
+                      help='Path of JSON results file [%default]')
+    opts, _ = parser.parse_args()
+    project_dir = os.path.abspath(
+        opts.project_dir or tempfile.mkdtemp(prefix='scons_bench.'))
+    generate_project.generate_project(project_dir, opts)
+    results = run_benchmarks(project_dir, opts)
+    report = dict(
+        timestamp=time.time(), host=platform.node(),
+        params=dict((key, getattr(opts, key)) for key in (
+            'modules', 'depth', 'protos', 'sources', 'fanout', 'prog_every',
+            'seed', 'jobs')),
+        results=results)
+    with open(opts.output, 'w') as out_file:
+        json.dump(report, out_file, indent=2, sort_keys=True)
+    print json.dumps(results, indent=2, sort_keys=True)
+    print 'Results written to %s (project in %s)' % (opts.output,
+                                                    project_dir)
+
+if '__main__' == __name__:
+    main()
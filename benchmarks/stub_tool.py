@@ -0,0 +1,99 @@
+# Copyright 2015 The Ostrich / by Itamar O
+
+"""Stub toolchain for build-system benchmarks.
+
+usage: python stub_tool.py cc|ar|ranlib|protoc [TOOL ARGS...]
+
+Mimics the outputs of the real tools (objects, archives, programs, generated
+protobuf sources), writing small files derived from the inputs content,
+so benchmarks measure the build system and not the compiler.
+"""
+
+import hashlib
+import os
+import re
+import sys
+
+_IMPORT_RE = re.compile(r'^import\s+"(.+)\.proto"\s*;', re.M)
+
+def _write(path, content):
+    """Write content to path, creating parent directories as needed."""
+    parent = os.path.dirname(path)
+    if parent and not os.path.isdir(parent):
+        os.makedirs(parent)
+    with open(path, 'w') as out_file:
+        out_file.write(content)
+
+def _digest(paths):
+    """Return hex digest of the contents of existing files in `paths`."""
+    md5 = hashlib.md5()
+    for path in paths:
+        if os.path.isfile(path):
+            with open(path, 'rb') as in_file:
+                md5.update(in_file.read())
+    return md5.hexdigest()
+
+def stub_cc(args):
+    """Compile / link: write -o target with digest of the input files
+    (and its `.dwo` file when compiling with split DWARF)."""
+    output = None
+    inputs = list()
+    split_dwarf = '-c' in args and '-gsplit-dwarf' in args
+    args = iter(args)
+    for arg in args:
+        if '-o' == arg:
+            output = next(args)
+        elif arg in ('-MF', '-MT', '-include', '-include-pch', '-x'):
+            next(args)
+        elif not arg.startswith('-'):
+            inputs.append(arg)
+    if output:
+        _write(output, 'stub %s\n' % (_digest(inputs)))
+        if split_dwarf:
+            _write(os.path.splitext(output)[0] + '.dwo',
+                   'stub-dwo %s\n' % (_digest(inputs)))
+
+def stub_ar(args):
+    """Archive: `ar FLAGS ARCHIVE OBJECTS...`"""
+    _write(args[1], 'stub-ar %s\n' % (_digest(args[2:])))
+
+def stub_protoc(args):
+    """Generate .pb.cc / .pb.h for every proto (relative to proto path)."""
+    proto_paths = ['.']
+    cpp_out = None
+    protos = list()
+    for arg in args:
+        if arg.startswith('--proto_path='):
+            proto_paths.append(arg.split('=', 1)[1])
+        elif arg.startswith('--cpp_out='):
+            cpp_out = arg.split('=', 1)[1]
+        elif not arg.startswith('-'):
+            protos.append(arg)
+    for proto in protos:
+        rel_path = proto
+        for proto_path in proto_paths[1:]:
+            if proto.startswith(proto_path.rstrip('/') + '/'):
+                rel_path = proto[len(proto_path.rstrip('/')) + 1:]
+        base = os.path.splitext(rel_path)[0]
+        with open(proto) as proto_file:
+            imports = _IMPORT_RE.findall(proto_file.read())
+        header = ''.join('#include "%s.pb.h"\n' % (imp) for imp in imports)
+        if cpp_out:
+            _write(os.path.join(cpp_out, base + '.pb.h'), header)
+            _write(os.path.join(cpp_out, base + '.pb.cc'),
+                   '#include "%s.pb.h"\n' % (base))
+
+def main():
+    """Dispatch to the requested stub tool."""
+    tool, args = sys.argv[1], sys.argv[2:]
+    if 'cc' == tool:
+        stub_cc(args)
+    elif 'ar' == tool:
+        stub_ar(args)
+    elif 'protoc' == tool:
+        stub_protoc(args)
+    elif 'ranlib' != tool:
+        sys.exit('Unknown stub tool %s' % (tool))
+
+if '__main__' == __name__:
+    main()
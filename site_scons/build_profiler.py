@@ -0,0 +1,177 @@
+# Copyright 2015 The Ostrich / by Itamar O
+
+"""Build phase profiler, writing Chrome / Perfetto trace-event JSON.
+
+Enabled by `scons --profile-build=trace.json`.
+Records spans for build-system phases (base env, module discovery,
+SConscript reading, library resolution), and for every executed action
+(with its job slot and CacheDir / object cache result), writes them as
+trace events
+(to be opened in chrome://tracing or https://ui.perfetto.dev),
+and prints a summary of the top spans at exit.
+"""
+
+import atexit
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from object_cache import read_results
+from site_utils import sprint
+
+class BuildProfiler(object):
+    """Collects timed spans and writes them as trace events."""
+
+    def __init__(self):
+        self._trace_path = None
+        self._top_n = 0
+        self._events = list()
+        # Thread ident -> job slot (main thread is slot 0)
+        self._slots = dict()
+        self._slots_lock = threading.Lock()
+        self._start_time = time.time()
+        # Object cache stats file, read offset, and object path -> result
+        self._objcache_stats = None
+        self._objcache_offset = 0
+        self._objcache_results = dict()
+        self._objcache_lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        """True if profiling is enabled."""
+        return bool(self._trace_path)
+
+    def enable(self, trace_path, top_n=15):
+        """Enable profiling, writing trace to `trace_path` at exit.
+
+        @param trace_path   Path of trace-event JSON file to write
+        @param top_n        Number of top spans to print in the summary
+        """
+        if self._trace_path:
+            return
+        self._trace_path = trace_path
+        self._top_n = top_n
+        self._slots[threading.current_thread().ident] = 0
+        self._hook_build_tasks()
+        atexit.register(self._finish)
+
+    def track_object_cache(self, stats_path):
+        """Read object cache results of actions from stats file
+        `stats_path` (see object_cache.py)."""
+        self._objcache_stats = stats_path
+
+    def cache_result(self, target):
+        """Return cache result of the action that built target - "hit" for
+        CacheDir hits, the object cache result for wrapped compiles, or
+        "miss"."""
+        if getattr(target, 'cached', 0):
+            return 'hit'
+        if not self._objcache_stats:
+            return 'miss'
+        with self._objcache_lock:
+            results, self._objcache_offset = read_results(
+                self._objcache_stats, self._objcache_offset)
+            self._objcache_results.update(results)
+            return self._objcache_results.get(target.get_abspath(), 'miss')
+
+    @contextmanager
+    def span(self, name, category, **args):
+        """Context manager that records a span (if profiling is enabled).
+
+        @param name         Span name
+        @param category     Span category (e.g. "sconscript")
+        @param args         Extra span details to record
+        """
+        if not self._trace_path:
+            yield
+            return
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.add_span(name, category, start_time, time.time(), **args)
+
+    def add_span(self, name, category, start_time, end_time, **args):
+        """Record a span that started and ended at given times."""
+        if not self._trace_path:
+            return
+        self._events.append(dict(
+            name=name, cat=category, ph='X', pid=os.getpid(),
+            tid=self._job_slot(),
+            ts=int((start_time - self._start_time) * 1e6),
+            dur=int((end_time - start_time) * 1e6),
+            args=args))
+
+    def _job_slot(self):
+        """Return the job slot number of the current thread."""
+        ident = threading.current_thread().ident
+        if ident not in self._slots:
+            with self._slots_lock:
+                self._slots.setdefault(ident, len(self._slots))
+        return self._slots[ident]
+
+    def _hook_build_tasks(self):
+        """Wrap SCons build task execution to record executed actions."""
+        from SCons.Script.Main import BuildTask
+        orig_execute = BuildTask.execute
+        profiler = self
+        def execute(task):
+            """Execute build task, recording a span for it."""
+            start_time = time.time()
+            try:
+                orig_execute(task)
+            finally:
+                target = task.targets[0]
+                profiler.add_span(
+                    str(target), _builder_name(target),
+                    start_time, time.time(),
+                    targets=[str(tgt) for tgt in task.targets],
+                    cache=profiler.cache_result(target))
+        BuildTask.execute = execute
+
+    def _finish(self):
+        """Write the trace file and print a summary."""
+        events = list(self._events)
+        for slot in self._slots.values():
+            events.append(dict(
+                name='thread_name', ph='M', pid=os.getpid(), tid=slot,
+                args=dict(name='main' if slot == 0 else 'job %d' % (slot))))
+        try:
+            with open(self._trace_path, 'w') as trace_file:
+                json.dump(dict(traceEvents=events, displayTimeUnit='ms'),
+                          trace_file)
+        except IOError as exc:
+            sprint('Failed writing build profile %s: %s',
+                   self._trace_path, exc)
+            return
+        self._print_summary()
+        sprint('Build profile written to %s', self._trace_path)
+
+    def _print_summary(self):
+        """Print totals per category and the top spans by duration."""
+        spans = self._events
+        totals = defaultdict(lambda: [0, 0])
+        for event in spans:
+            totals[event['cat']][0] += 1
+            totals[event['cat']][1] += event['dur']
+        sprint('Build profile - time per category:')
+        for category, (count, dur) in sorted(totals.iteritems(),
+                                             key=lambda item: -item[1][1]):
+            sprint('  %10.3f sec  %5d x %s', dur / 1e6, count, category)
+        sprint('Build profile - top %d spans:', self._top_n)
+        for event in sorted(spans, key=lambda evt: -evt['dur'])[:self._top_n]:
+            sprint('  %10.3f sec  [%s] %s', event['dur'] / 1e6,
+                   event['cat'], event['name'])
+
+def _builder_name(node):
+    """Return name of the builder of node (or "action" if unknown)."""
+    try:
+        return node.get_builder().get_name(node.get_build_env())
+    except Exception:  # pylint: disable=broad-except
+        return 'action'
+
+# Profiler instance for this run
+profiler = BuildProfiler()  # pylint: disable=invalid-name
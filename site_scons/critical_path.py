@@ -0,0 +1,223 @@
+# Copyright 2015 The Ostrich / by Itamar O
+
+"""Critical-path-aware job scheduling, from historical action durations.
+
+Action durations are recorded for every built target, and persisted for
+following runs.
+The SCons taskmaster visits the children of every node in the order given
+by an order function, so children with the longest estimated chain of
+actions below them (their critical path) are visited first, and their
+actions start as early as possible with parallel jobs.
+Until durations were recorded (on the first run), the default SCons order
+is kept.
+
+Scheduling is enabled by setting ACTION_DURATIONS in site_config.
+
+With `scons --critical-path-report`, the estimated critical path (from
+historical durations) and the actual critical path (from this run
+durations) are printed at exit.
+"""
+
+import atexit
+import os
+import threading
+import time
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from SCons.Node.FS import File
+
+from site_utils import sprint
+
+# Weight of the latest duration in the persistent (smoothed) duration
+_LATEST_WEIGHT = 0.5
+
+# Maximum number of critical path targets to print in the report
+_REPORT_MAX_TARGETS = 12
+
+class CriticalPathScheduler(object):
+    """Orders SCons taskmaster candidates by historical critical path."""
+
+    def __init__(self):
+        self._durations_path = None
+        self._report = False
+        # Target path -> smoothed duration in seconds (from previous runs)
+        self._durations = dict()
+        self._default_duration = 0.0
+        # Target path -> duration in seconds (in this run)
+        self._actual = dict()
+        self._actual_lock = threading.Lock()
+        # Node -> estimated critical path duration (cached)
+        self._estimates = dict()
+        self._top_targets = list()
+        self._build_start = None
+
+    @property
+    def enabled(self):
+        """True if critical path scheduling is enabled."""
+        return bool(self._durations_path)
+
+    def enable(self, durations_path, report=False):
+        """Enable scheduling by durations persisted in `durations_path`.
+
+        @param durations_path   Path of persistent action durations file
+        @param report           Whether to print a critical path report
+        """
+        if self._durations_path:
+            return
+        self._durations_path = os.path.abspath(durations_path)
+        self._report = report
+        self._load()
+        self._hook_taskmaster()
+        self._hook_build_tasks()
+        atexit.register(self._finish)
+
+    def order(self, nodes):
+        """Return nodes in taskmaster candidates order.
+
+        The taskmaster pops candidates from the end of the list, so nodes
+         are sorted by increasing estimated critical path.
+        """
+        return sorted(nodes, key=self._estimate)
+
+    def _duration(self, node, durations, default):
+        """Return duration of the action that builds node (0 for sources)."""
+        if not isinstance(node, File) or not node.has_builder():
+            return 0.0
+        return durations.get(str(node), default)
+
+    def _critical_path(self, node, durations, default, cache):
+        """Return critical path duration of node (building node included).
+
+        The critical path of a node is the longest chain of actions from
+         node down to its sources (by sum of `durations`).
+        Results are stored in `cache` (node -> duration).
+        """
+        stack = [node]
+        visiting = set()
+        while stack:
+            cur = stack[-1]
+            if cur in cache:
+                stack.pop()
+                continue
+            visiting.add(cur)
+            children = cur.all_children(scan=0)
+            pending = [child for child in children
+                       if child not in cache and child not in visiting]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            visiting.discard(cur)
+            cache[cur] = self._duration(cur, durations, default) + max(
+                [cache.get(child, 0.0) for child in children] or [0.0])
+        return cache[node]
+
+    def _estimate(self, node):
+        """Return estimated critical path of node (historical durations)."""
+        return self._critical_path(node, self._durations,
+                                   self._default_duration, self._estimates)
+
+    def _hook_taskmaster(self):
+        """Wrap SCons taskmaster init to use our order function."""
+        from SCons import Taskmaster
+        from SCons.Script import GetOption
+        orig_init = Taskmaster.Taskmaster.__init__
+        scheduler = self
+        def __init__(taskmaster, targets=None, tasker=None, order=None,
+                     trace=None):
+            """Initialize taskmaster with critical path order function."""
+            orig_init(taskmaster, targets or [], tasker, order, trace)
+            if scheduler._durations and not GetOption('random'):  # pylint: disable=protected-access
+                taskmaster.order = scheduler.order
+            scheduler._top_targets = list(targets or [])  # pylint: disable=protected-access
+            scheduler._build_start = time.time()  # pylint: disable=protected-access
+        Taskmaster.Taskmaster.__init__ = __init__
+
+    def _hook_build_tasks(self):
+        """Wrap SCons build task execution to record action durations."""
+        from SCons.Script.Main import BuildTask
+        orig_execute = BuildTask.execute
+        scheduler = self
+        def execute(task):
+            """Execute build task, recording its duration."""
+            start_time = time.time()
+            orig_execute(task)
+            duration = time.time() - start_time
+            with scheduler._actual_lock:  # pylint: disable=protected-access
+                for target in task.targets:
+                    scheduler._actual[str(target)] = duration  # pylint: disable=protected-access
+        BuildTask.execute = execute
+
+    def _load(self):
+        """Load durations from the persistent durations file."""
+        try:
+            with open(self._durations_path, 'rb') as durations_file:
+                self._durations = pickle.load(durations_file)
+        except (IOError, EOFError, ValueError, TypeError,
+                pickle.UnpicklingError):
+            self._durations = dict()
+        if self._durations:
+            self._default_duration = (sum(self._durations.itervalues()) /
+                                      len(self._durations))
+
+    def _finish(self):
+        """Print critical path report (if requested), and save durations."""
+        if not self._actual:
+            return
+        if self._report:
+            self._print_report()
+        durations = dict(self._durations)
+        for target, duration in self._actual.iteritems():
+            if target in durations:
+                duration = (_LATEST_WEIGHT * duration +
+                            (1 - _LATEST_WEIGHT) * durations[target])
+            durations[target] = duration
+        try:
+            durations_dir = os.path.dirname(self._durations_path)
+            if not os.path.isdir(durations_dir):
+                os.makedirs(durations_dir)
+            tmp_path = '%s.%d' % (self._durations_path, os.getpid())
+            with open(tmp_path, 'wb') as durations_file:
+                pickle.dump(durations, durations_file,
+                            pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self._durations_path)
+        except (IOError, OSError):
+            sprint('Failed writing action durations %s', self._durations_path)
+
+    def _chain(self, durations, default, cache):
+        """Return (duration, chain of targets) of the top critical path."""
+        if not self._top_targets:
+            return 0.0, []
+        node = max(self._top_targets, key=lambda top: self._critical_path(
+            top, durations, default, cache))
+        total = cache[node]
+        chain = list()
+        while node is not None:
+            duration = self._duration(node, durations, default)
+            if duration:
+                chain.append((str(node), duration))
+            children = node.all_children(scan=0)
+            node = max(children, key=lambda child: cache.get(child, 0.0)) \
+                if children else None
+        return total, chain
+
+    def _print_report(self):
+        """Print estimated and actual critical paths."""
+        build_time = time.time() - (self._build_start or time.time())
+        for title, durations, default in (
+                ('Estimated', self._durations, self._default_duration),
+                ('Actual', self._actual, 0.0)):
+            total, chain = self._chain(durations, default, dict())
+            sprint('%s critical path: %.3f sec (%d actions)',
+                   title, total, len(chain))
+            for target, duration in chain[:_REPORT_MAX_TARGETS]:
+                sprint('  %10.3f sec  %s', duration, target)
+            if len(chain) > _REPORT_MAX_TARGETS:
+                sprint('  ... (%d more)', len(chain) - _REPORT_MAX_TARGETS)
+        sprint('Build (actions) wall time: %.3f sec', build_time)
+
+# Scheduler instance for this run
+scheduler = CriticalPathScheduler()  # pylint: disable=invalid-name
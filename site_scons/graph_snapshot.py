@@ -0,0 +1,126 @@
+# Copyright 2015 The Ostrich / by Itamar O
+
+"""Build graph snapshots, for near-instant null builds.
+
+A snapshot is recorded after a successful build, per invocation context
+(active flavor from the environment, command line targets, launch dir and
+climb up option).
+It holds a fingerprint of the build configuration (SConstruct, site_scons
+scripts, and every module SConscript), and the state (mtime & size) of
+every file node in the build graph (sources, headers found by scanners,
+tools, targets, and even looked-up files that didn't exist).
+Every target that the build visited must exist - a snapshot isn't recorded
+if one of them is missing after the build (e.g. a side target that its
+action didn't write), and is out of date if one of them is removed.
+
+If nothing in the snapshot changed, the next invocation in the same
+context can skip reading SConscripts and building the graph altogether,
+because SCons would find everything up to date anyway.
+"""
+
+import atexit
+import hashlib
+import os
+import time
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from site_utils import sprint
+
+def _file_state(path):
+    """Return (mtime, size) of file in `path` (None if it doesn't exist)."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+class GraphSnapshot(object):
+    """Snapshot of the build graph files state for an invocation context."""
+
+    def __init__(self, snapshot_dir, context, config_paths):
+        """Initialize graph snapshot for context.
+
+        @param snapshot_dir     Directory for storing snapshot files
+        @param context          Value identifying the invocation context
+        @param config_paths     List of build configuration file paths
+        """
+        self._path = os.path.join(snapshot_dir,
+                                  hashlib.md5(repr(context)).hexdigest())
+        self._config = [(path, _file_state(path)) for path in config_paths]
+        self._start_time = time.time()
+
+    def is_up_to_date(self):
+        """Return True if configuration and every file is unchanged."""
+        try:
+            with open(self._path, 'rb') as snapshot_file:
+                config, files, targets = pickle.load(snapshot_file)
+        except (IOError, EOFError, ValueError, TypeError,
+                pickle.UnpicklingError):
+            return False
+        if config != self._config:
+            return False
+        for path in targets:
+            if not os.path.exists(path):
+                return False
+        for path, state in files:
+            if _file_state(path) != state:
+                return False
+        return True
+
+    def save_at_exit(self):
+        """Record the snapshot when SCons exits (if the build succeeded)."""
+        atexit.register(self._save)
+
+    def _save(self):
+        """Record the state of every file node in the build graph."""
+        from SCons.Script import GetBuildFailures
+        import SCons.Node
+        import SCons.Node.FS
+        if GetBuildFailures():
+            return
+        files = list()
+        targets = list()
+        for node in _file_nodes(SCons.Node.FS.get_default_fs()):
+            path = node.get_abspath()
+            state = _file_state(path)
+            if not node.has_builder():
+                if state and state[0] >= self._start_time:
+                    # A source changed during the build - can't trust its state
+                    return
+            elif node.get_state() in (SCons.Node.up_to_date,
+                                      SCons.Node.executed):
+                if state is None:
+                    # A target of the build is missing - SCons would rebuild it
+                    sprint('Not recording graph snapshot (missing target %s)',
+                           node)
+                    return
+                targets.append(path)
+            files.append((path, state))
+        try:
+            snapshot_dir = os.path.dirname(self._path)
+            if not os.path.isdir(snapshot_dir):
+                os.makedirs(snapshot_dir)
+            tmp_path = '%s.%d' % (self._path, os.getpid())
+            with open(tmp_path, 'wb') as snapshot_file:
+                pickle.dump((self._config, files, targets), snapshot_file,
+                            pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self._path)
+        except (IOError, OSError):
+            sprint('Failed writing graph snapshot %s', self._path)
+
+def _file_nodes(fs):
+    """Generate every non-directory node known to SCons FS `fs`."""
+    import SCons.Node.FS
+    stack = [fs.Top.root]
+    while stack:
+        dir_node = stack.pop()
+        for name, node in dir_node.entries.iteritems():
+            if name in ('.', '..'):
+                continue
+            if isinstance(node, SCons.Node.FS.Dir):
+                stack.append(node)
+            elif not os.path.isdir(node.get_abspath()):
+                yield node
@@ -0,0 +1,487 @@
+# Copyright 2015 The Ostrich / by Itamar O
+
+"""Shared object cache - a caching compiler wrapper.
+
+usage: python object_cache.py [OPTIONS] -- COMPILER ARGS...
+       python object_cache.py serve --dir=DIR [--port=PORT]
+
+Wraps compile commands (`COMPILER ... -c SOURCE -o OBJECT`), keying the
+object by the preprocessed source, the compiler arguments, and the compiler
+identity (its `--version` output), so the same object is compiled once,
+and reused by every build with the same flags (on any machine sharing the
+cache).
+
+With split DWARF (`-gsplit-dwarf`), the `.dwo` file of the object is
+cached along with it (under a key derived from the object key).
+
+Cache backends:
+  - Local directory (--dir), with size-capped LRU eviction (--max-size).
+  - Optional HTTP server (--url), tried after the local directory
+    (GET / PUT of /KEY). `serve` runs a simple stand-in server, storing
+    objects in a local directory.
+Every wrapped command appends its result (hit, miss, ...) and its object
+path to a stats file (--stats), that SCons summarizes at the end of the
+build (and the build profiler reads per target).
+With --remote-workers, compiles that miss the cache run on remote workers
+(see remote_exec.py).
+"""
+
+import BaseHTTPServer
+import SocketServer
+import errno
+import hashlib
+import httplib
+import optparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import thread
+import urllib2
+
+# Fraction of the size limit to shrink a full cache dir to on eviction
+_EVICT_TARGET = 0.9
+
+# Number of cache sub-directories (keys are spread by their first 2 chars)
+_NUM_SUBDIRS = 256
+
+def _tmp_path(path):
+    """Return unique temporary path (for this process & thread) for path."""
+    return '%s.tmp.%d.%d' % (path, os.getpid(), thread.get_ident())
+
+def _atomic_copy(src_path, dst_path):
+    """Copy file to `dst_path` via a temporary file in the same dir."""
+    tmp_path = _tmp_path(dst_path)
+    try:
+        shutil.copyfile(src_path, tmp_path)
+        os.rename(tmp_path, dst_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+class LocalCache(object):
+    """Object cache in a local directory, with size-capped LRU eviction.
+
+    Objects are stored in sub-directories by key prefix, and every cache
+     hit updates the object mtime, so eviction removes the least recently
+     used objects of a sub-directory when it exceeds its share of the
+     maximum cache size.
+    All writes go through temporary files renamed into place, so concurrent
+     builds (and parallel jobs) never see partial objects.
+    """
+
+    def __init__(self, cache_dir, max_size=0):
+        """Initialize local cache.
+
+        @param cache_dir    Cache directory (created as needed)
+        @param max_size     Maximum cache size in bytes (0 for unlimited)
+        """
+        self.cache_dir = cache_dir
+        self._max_subdir_size = max_size // _NUM_SUBDIRS
+
+    def _path(self, key):
+        """Return path of object with `key` in the cache."""
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key, out_path):
+        """Copy object `key` to `out_path`, return True if found."""
+        obj_path = self._path(key)
+        try:
+            _atomic_copy(obj_path, out_path)
+            os.utime(obj_path, None)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def put(self, key, obj_path):
+        """Store object file `obj_path` under `key`."""
+        cache_path = self._path(key)
+        subdir = os.path.dirname(cache_path)
+        try:
+            os.makedirs(subdir)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        _atomic_copy(obj_path, cache_path)
+        if self._max_subdir_size:
+            self._evict(subdir)
+
+    def _evict(self, subdir):
+        """Remove least recently used objects in `subdir` if it's too big."""
+        entries = list()
+        total_size = 0
+        for name in os.listdir(subdir):
+            try:
+                stat = os.stat(os.path.join(subdir, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+            total_size += stat.st_size
+        if total_size <= self._max_subdir_size:
+            return
+        for _, size, name in sorted(entries):
+            try:
+                os.remove(os.path.join(subdir, name))
+            except OSError:
+                pass
+            total_size -= size
+            if total_size <= self._max_subdir_size * _EVICT_TARGET:
+                break
+
+class HttpCache(object):
+    """Object cache on an HTTP server (GET / PUT of objects by key)."""
+
+    def __init__(self, url, timeout=10):
+        """Initialize HTTP cache client.
+
+        @param url      Base URL of the cache server
+        @param timeout  Request timeout in seconds
+        """
+        self._url = url.rstrip('/')
+        self._timeout = timeout
+
+    def get(self, key, out_path):
+        """Download object `key` to `out_path`, return True if found."""
+        tmp_path = _tmp_path(out_path)
+        try:
+            response = urllib2.urlopen('%s/%s' % (self._url, key),
+                                       timeout=self._timeout)
+            with open(tmp_path, 'wb') as out_file:
+                shutil.copyfileobj(response, out_file)
+            os.rename(tmp_path, out_path)
+        except (IOError, OSError, httplib.HTTPException):
+            return False
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return True
+
+    def put(self, key, obj_path):
+        """Upload object file `obj_path` under `key`."""
+        with open(obj_path, 'rb') as obj_file:
+            request = urllib2.Request('%s/%s' % (self._url, key),
+                                      data=obj_file.read())
+        request.get_method = lambda: 'PUT'
+        urllib2.urlopen(request, timeout=self._timeout).read()
+
+def _output_path(args):
+    """Return the `-o` output path in compiler arguments (None if missing)."""
+    for idx, arg in enumerate(args[:-1]):
+        if '-o' == arg:
+            return args[idx + 1]
+    return None
+
+def _compiler_identity(compiler, cache_dir):
+    """Return identity of compiler (its `--version` output).
+
+    The identity is cached (in `cache_dir`) by compiler path, size & mtime,
+     so it is not computed for every compilation.
+    """
+    compiler_path = os.path.realpath(_which(compiler) or compiler)
+    try:
+        stat = os.stat(compiler_path)
+    except OSError:
+        return compiler
+    id_path = None
+    if cache_dir:
+        id_path = os.path.join(cache_dir, 'compilers', hashlib.md5(repr(
+            (compiler_path, stat.st_size, stat.st_mtime))).hexdigest())
+        try:
+            with open(id_path) as id_file:
+                return id_file.read()
+        except IOError:
+            pass
+    proc = subprocess.Popen([compiler, '--version'], stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    identity = proc.communicate()[0]
+    if id_path and 0 == proc.returncode:
+        try:
+            if not os.path.isdir(os.path.dirname(id_path)):
+                os.makedirs(os.path.dirname(id_path))
+            with open(_tmp_path(id_path), 'w') as id_file:
+                id_file.write(identity)
+            os.rename(_tmp_path(id_path), id_path)
+        except (IOError, OSError):
+            pass
+    return identity
+
+def _which(program):
+    """Return full path of program in PATH (None if not found)."""
+    if os.path.dirname(program):
+        return program
+    for path_dir in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(path_dir, program)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+def cache_key(args, cache_dir=None):
+    """Return cache key for compile command `args` (None if not cacheable).
+
+    The key covers the compiler identity, the compiler arguments (except
+     the output path), the preprocessed source (which covers included
+     headers and macro definitions), and precompiled headers.
+    With debug info (`-g`), the current directory is covered as well,
+     because it's recorded in the object.
+    """
+    if '-c' not in args or not _output_path(args):
+        return None
+    md5 = hashlib.md5()
+    md5.update(_compiler_identity(args[0], cache_dir))
+    pp_args = list()
+    arg_iter = iter(args)
+    for arg in arg_iter:
+        if '-o' == arg:
+            next(arg_iter)
+            md5.update('\0-o')
+            continue
+        if '-MF' == arg:
+            # Preprocessing writes the depfile too, so it exists on a hit
+            pp_args.extend([arg, next(arg_iter)])
+            md5.update('\0-MF')
+            continue
+        md5.update('\0' + arg)
+        pp_args.append('-E' if '-c' == arg else arg)
+    if any(arg.startswith('-g') for arg in args):
+        md5.update('\0' + os.getcwd())
+    # Preprocessing with a precompiled header doesn't expand its headers
+    for idx, arg in enumerate(args[:-1]):
+        if '-include-pch' == arg:
+            try:
+                with open(args[idx + 1], 'rb') as pch_file:
+                    for chunk in iter(lambda: pch_file.read(65536), ''):
+                        md5.update(chunk)
+            except IOError:
+                return None
+    # Preprocessor errors are reported by the compile command itself
+    with open(os.devnull, 'w') as devnull:
+        proc = subprocess.Popen(pp_args, stdout=subprocess.PIPE,
+                                stderr=devnull)
+        for chunk in iter(lambda: proc.stdout.read(65536), ''):
+            md5.update(chunk)
+        proc.wait()
+    if proc.returncode:
+        return None
+    return md5.hexdigest()
+
+def run_cached(args, backends, cache_dir=None, runner=subprocess.call):
+    """Run compile command `args` using cache backends.
+
+    Compiles that miss the cache are run with `runner` (a function of the
+     command arguments that returns the exit code).
+    Return (exit code, result), where result is one of
+     "hit", "miss", "uncacheable" or "failed".
+    """
+    key = cache_key(args, cache_dir)
+    if not key:
+        return runner(args), 'uncacheable'
+    outputs = _outputs(args, key)
+    for idx, backend in enumerate(backends):
+        if all(backend.get(out_key, out_path)
+               for out_key, out_path in outputs):
+            # Fill in faster backends that missed
+            _put(backends[:idx], outputs)
+            return 0, 'hit'
+    ret = runner(args)
+    if ret:
+        return ret, 'failed'
+    _put(backends, outputs)
+    return 0, 'miss'
+
+def _outputs(args, key):
+    """Return list of (cache key, path) of the outputs of compile command
+    `args` with cache key `key` - the object, and its `.dwo` file with
+    split DWARF."""
+    out_path = _output_path(args)
+    outputs = [(key, out_path)]
+    if '-gsplit-dwarf' in args:
+        outputs.append((hashlib.md5(key + '\0.dwo').hexdigest(),
+                        os.path.splitext(out_path)[0] + '.dwo'))
+    return outputs
+
+def _put(backends, outputs):
+    """Store outputs in backends (ignoring backend errors).
+
+    The object is stored last (after its other outputs).
+    """
+    for backend in backends:
+        try:
+            for out_key, out_path in reversed(outputs):
+                backend.put(out_key, out_path)
+        except (IOError, OSError, httplib.HTTPException):
+            pass
+
+def record_result(stats_path, result, out_path=None):
+    """Append a result line ("RESULT OBJECT-PATH") to the stats file
+    (if specified)."""
+    if stats_path:
+        line = '%s %s\n' % (result,
+                              os.path.abspath(out_path) if out_path else '')
+        # Single small appends are atomic, so parallel jobs don't mix lines
+        stats_fd = os.open(stats_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(stats_fd, line)
+        finally:
+            os.close(stats_fd)
+
+def read_results(stats_path, offset=0):
+    """Return (object path -> result, end offset) of the result lines in
+    the stats file from `offset` (complete lines only)."""
+    try:
+        with open(stats_path) as stats_file:
+            stats_file.seek(offset)
+            content = stats_file.read()
+    except IOError:
+        return dict(), offset
+    content = content[:content.rfind('\n') + 1]
+    results = dict()
+    for line in content.splitlines():
+        result, _, out_path = line.partition(' ')
+        results[out_path] = result
+    return results, offset + len(content)
+
+def report_stats(stats_path):
+    """Print summary of results in stats file, and remove it."""
+    from site_utils import sprint
+    try:
+        with open(stats_path) as stats_file:
+            results = [line.split(' ', 1)[0] for line in stats_file]
+        os.remove(stats_path)
+    except (IOError, OSError):
+        return
+    hits = results.count('hit')
+    misses = results.count('miss')
+    sprint('Object cache: %d hits, %d misses (%.1f%% hit rate), '
+           '%d uncacheable, %d failed', hits, misses,
+           100.0 * hits / max(1, hits + misses),
+           results.count('uncacheable'), results.count('failed'))
+
+def parse_size(size):
+    """Return number of bytes in size string (e.g. "500M", "5G")."""
+    match = re.match(r'^(\d+(?:\.\d+)?)\s*([KMGT]?)B?$', str(size).upper())
+    if not match:
+        raise ValueError('Invalid size "%s"' % (size))
+    return int(float(match.group(1)) *
+               1024 ** ' KMGT'.index(match.group(2) or ' '))
+
+class _CacheRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Stand-in cache server request handler (GET / PUT /KEY)."""
+
+    # Local cache that stores the objects (set by `serve`)
+    storage = None
+
+    def _key(self):
+        """Return requested key (None if invalid)."""
+        key = self.path.strip('/')
+        return key if re.match(r'^[0-9a-f]{32}$', key) else None
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Send object if it's in the cache."""
+        key = self._key()
+        tmp_path = _tmp_path(os.path.join(self.storage.cache_dir,
+                                          'serve.%s' % (key)))
+        if not key or not self.storage.get(key, tmp_path):
+            self.send_error(404)
+            return
+        try:
+            with open(tmp_path, 'rb') as obj_file:
+                data = obj_file.read()
+        finally:
+            os.remove(tmp_path)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_PUT(self):  # pylint: disable=invalid-name
+        """Store uploaded object in the cache."""
+        key = self._key()
+        if not key:
+            self.send_error(400)
+            return
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        tmp_path = _tmp_path(os.path.join(self.storage.cache_dir,
+                                          'upload.%s' % (key)))
+        try:
+            with open(tmp_path, 'wb') as obj_file:
+                obj_file.write(data)
+            self.storage.put(key, tmp_path)
+        finally:
+            os.remove(tmp_path)
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """Don't log every request."""
+        pass
+
+class _ThreadedHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    """HTTP server that handles every request in a thread."""
+    daemon_threads = True
+
+def serve(argv):
+    """Run a stand-in cache server, storing objects in a local directory."""
+    parser = optparse.OptionParser(
+        usage='usage: %prog serve --dir=DIR [options]')
+    parser.add_option('--dir', help='Directory to store objects in')
+    parser.add_option('--max-size', default='0',
+                      help='Maximum cache size (e.g. 5G) [unlimited]')
+    parser.add_option('--host', default='127.0.0.1',
+                      help='Address to listen on [%default]')
+    parser.add_option('--port', type='int', default=8377,
+                      help='Port to listen on [%default]')
+    opts, _ = parser.parse_args(argv)
+    if not opts.dir:
+        parser.error('Missing --dir')
+    if not os.path.isdir(opts.dir):
+        os.makedirs(opts.dir)
+    _CacheRequestHandler.storage = LocalCache(opts.dir,
+                                              parse_size(opts.max_size))
+    server = _ThreadedHTTPServer((opts.host, opts.port), _CacheRequestHandler)
+    print 'Serving object cache from %s on http://%s:%d' % (
+        opts.dir, opts.host, server.server_port)
+    server.serve_forever()
+
+def main():
+    """Run compiler command with the object cache (or serve the cache)."""
+    if len(sys.argv) > 1 and 'serve' == sys.argv[1]:
+        serve(sys.argv[2:])
+        return
+    parser = optparse.OptionParser(
+        usage='usage: %prog [options] -- COMPILER ARGS...')
+    parser.disable_interspersed_args()
+    parser.add_option('--dir', default='',
+                      help='Local cache directory')
+    parser.add_option('--max-size', default='0',
+                      help='Maximum local cache size (e.g. 5G) [unlimited]')
+    parser.add_option('--url', default='',
+                      help='Base URL of HTTP cache server')
+    parser.add_option('--stats', default='',
+                      help='File to append result of command to')
+    parser.add_option('--remote-workers', default='',
+                      help='Comma-separated remote worker addresses '
+                      '(host:port) to run compiles on')
+    opts, args = parser.parse_args()
+    if not args:
+        parser.error('Missing compiler command')
+    runner = subprocess.call
+    workers = [worker for worker in opts.remote_workers.split(',') if worker]
+    if workers:
+        from remote_exec import run_remote
+        runner = lambda cmd: run_remote(cmd, workers)
+    backends = list()
+    if opts.dir:
+        backends.append(LocalCache(opts.dir, parse_size(opts.max_size)))
+    if opts.url:
+        backends.append(HttpCache(opts.url))
+    if not backends:
+        sys.exit(runner(args))
+    ret, result = run_cached(args, backends, opts.dir, runner)
+    record_result(opts.stats, result, _output_path(args))
+    sys.exit(ret)
+
+if '__main__' == __name__:
+    main()
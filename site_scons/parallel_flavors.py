@@ -0,0 +1,182 @@
+# Copyright 2015 The Ostrich / by Itamar O
+
+"""Process-parallel multi-flavor builds.
+
+With `scons --parallel-flavors`, every selected flavor is built by its own
+SCons process (with BUILD_FLAVOR set), instead of building the flavors one
+after another in one process, so reading SConscripts, building the graph
+and running the taskmaster use a core per flavor.
+
+The `-j` budget is split between the flavor processes, their output lines
+are prefixed with the flavor name, and the exit status is the first
+non-zero exit status of a flavor process (0 if all of them succeeded).
+
+Every flavor process has its own SCons signatures database and action
+durations file, so the processes don't write the same files.
+The flavor signatures databases start as copies of the main database, and
+are merged back into it when the flavor processes finish, so switching
+between parallel and serial flavor builds doesn't rebuild anything.
+Shared generated code (e.g. protoc outputs under $GENROOT) is generated
+before the flavor processes start, by one SCons process that builds the
+$GENROOT dir (with the default signatures database), and the flavor
+processes use the generated files as sources.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+from site_utils import sprint
+
+# Environment variable that marks a flavor build process
+FLAVOR_PROCESS_VAR = 'OSTRICH_FLAVOR_PROCESS'
+
+def is_flavor_process():
+    """Return True if this process is a flavor build process."""
+    return bool(os.environ.get(FLAVOR_PROCESS_VAR))
+
+def flavor_sconsign(flavor):
+    """Return name of the SCons signatures database of a flavor process."""
+    import SCons.SConsign
+    return '%s.%s' % (SCons.SConsign.DB_Name, flavor)
+
+def seed_sconsigns(flavors):
+    """Copy the main SCons signatures database to the flavor databases."""
+    import SCons.dblite
+    import SCons.SConsign
+    main_path = SCons.SConsign.DB_Name + SCons.dblite.dblite_suffix
+    if not os.path.isfile(main_path):
+        return
+    for flavor in flavors:
+        shutil.copyfile(main_path,
+                        flavor_sconsign(flavor) + SCons.dblite.dblite_suffix)
+
+def merge_sconsigns(flavors):
+    """Merge the flavor SCons signatures databases into the main database.
+
+    Only the entries (by directory) that a flavor process changed are
+     merged - every flavor database also holds the seeded (and possibly
+     stale) entries of other flavors, that must not override their fresh
+     entries.
+    Flavor processes build targets in different directories, so the
+     changed entries of different flavors don't conflict.
+    """
+    import SCons.dblite
+    import SCons.SConsign
+    main_db = SCons.dblite.open(SCons.SConsign.DB_Name, 'c')
+    seed = dict((key, main_db[key]) for key in main_db.keys())
+    for flavor in flavors:
+        try:
+            flavor_db = SCons.dblite.open(flavor_sconsign(flavor), 'r')
+        except IOError:
+            continue
+        for key in flavor_db.keys():
+            if flavor_db[key] != seed.get(key):
+                main_db[key] = flavor_db[key]
+    main_db.sync()
+
+def split_jobs(num_jobs, num_flavors):
+    """Return list of jobs per flavor, splitting `num_jobs` between flavors
+    (at least one job per flavor)."""
+    return [max(1, num_jobs // num_flavors + (1 if idx < num_jobs %
+                                                  num_flavors else 0))
+            for idx in xrange(num_flavors)]
+
+def flavor_args(argv, flavor, all_flavors, num_jobs):
+    """Return SCons command line arguments for a flavor build process.
+
+    The jobs and parallel flavors options are removed from `argv`, as well
+     as targets that are other flavor names (all of them if `flavor` is
+     None), and `-j <num_jobs>` is added.
+    The directory options (-C, -u, -U, -D) are removed too, because flavor
+     processes start in the top directory (the current directory of this
+     process).
+    """
+    args = list()
+    arg_iter = iter(argv)
+    for arg in arg_iter:
+        if arg in ('-j', '--jobs', '-C', '--directory'):
+            next(arg_iter, None)
+        elif (arg.startswith(('--jobs=', '--directory=', '-C')) or
+              arg in ('--parallel-flavors', '-u', '--up', '--search-up',
+                      '-U', '-D') or
+              (arg.startswith('-j') and arg[2:].isdigit())):
+            continue
+        elif arg in all_flavors and arg != flavor:
+            continue
+        else:
+            args.append(arg)
+    return args + ['-j', str(num_jobs)]
+
+def _relay_output(flavor, proc, lock):
+    """Print output lines of flavor process, prefixed with the flavor."""
+    for line in iter(proc.stdout.readline, ''):
+        with lock:
+            sys.stdout.write('[%s] %s' % (flavor, line))
+            sys.stdout.flush()
+
+def _start_process(name, args, env, lock):
+    """Start SCons process with `args` & `env`, relaying its output lines
+    prefixed with `name`, return (process, relay thread)."""
+    proc = subprocess.Popen([sys.executable, sys.argv[0]] + args, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    relay = threading.Thread(target=_relay_output, args=(name, proc, lock))
+    relay.start()
+    return proc, relay
+
+def generate_code(genroot, flavor, all_flavors, num_jobs, lock):
+    """Build the shared generated code dir in one SCons process (reading
+    SConscripts of `flavor`), return exit status."""
+    sprint('Starting shared codegen process (-j %d)', num_jobs)
+    env = dict(os.environ, BUILD_FLAVOR=flavor, PYTHONUNBUFFERED='1')
+    proc, relay = _start_process(
+        'codegen', flavor_args(sys.argv[1:], None, all_flavors, num_jobs) +
+        [genroot], env, lock)
+    ret = proc.wait()
+    relay.join()
+    if ret:
+        sprint('Shared codegen failed (exit status %d)', ret)
+    return ret
+
+def build_flavors(flavors, num_jobs, all_flavors, genroot=None):
+    """Build flavors in parallel SCons processes, return exit status.
+
+    @param flavors      List of flavors to build
+    @param num_jobs     Total number of parallel jobs (split between flavors)
+    @param all_flavors  List of all known flavors
+    @param genroot      Shared generated code dir to build before the
+                        flavors (None if code is generated per flavor)
+    """
+    start_time = time.time()
+    lock = threading.Lock()
+    if genroot:
+        status = generate_code(genroot, flavors[0], all_flavors, num_jobs,
+                               lock)
+        if status:
+            return status
+    seed_sconsigns(flavors)
+    procs = list()
+    relays = list()
+    for flavor, jobs in zip(flavors, split_jobs(num_jobs, len(flavors))):
+        env = dict(os.environ, BUILD_FLAVOR=flavor, PYTHONUNBUFFERED='1')
+        env[FLAVOR_PROCESS_VAR] = '1'
+        sprint('Starting flavor %s build process (-j %d)', flavor, jobs)
+        proc, relay = _start_process(
+            flavor, flavor_args(sys.argv[1:], flavor, all_flavors, jobs),
+            env, lock)
+        procs.append((flavor, proc))
+        relays.append(relay)
+    status = 0
+    for (flavor, proc), relay in zip(procs, relays):
+        ret = proc.wait()
+        relay.join()
+        if ret:
+            sprint('Flavor %s build failed (exit status %d)', flavor, ret)
+            status = status or ret
+    merge_sconsigns(flavors)
+    sprint('Built %d flavors in parallel processes in %.3f sec',
+           len(flavors), time.time() - start_time)
+    return status
@@ -0,0 +1,551 @@
+# Copyright 2015 The Ostrich / by Itamar O
+
+"""Remote execution of compile and protoc actions on a pool of workers.
+
+usage: python remote_exec.py run --workers=HOST:PORT,... [--output=PATH]...
+                                 -- COMMAND ARGS...
+       python remote_exec.py worker [--host=HOST] [--port=PORT] [--jobs=N]
+                                    [--allow=TOOL,...]
+       python remote_exec.py pool [--workers=N] [--base-port=PORT] [--jobs=N]
+
+`run` executes a command on one of the workers:
+  - Compile commands (`-c`) are preprocessed locally (which also writes the
+    depfile, if requested), and the preprocessed source is compiled on the
+    worker.
+  - protoc commands send the proto sources with their (transitive) imports.
+  - Other commands (or commands with inputs / outputs outside the current
+    directory) run locally.
+Inputs are identified by content hash, and the worker asks only for the
+inputs it doesn't have. The worker runs the command in a sandbox dir with
+the inputs, and sends back its exit code, output and output files.
+Failed connections are retried on other workers, and if all attempts fail,
+the command runs locally.
+
+Workers execute only requests with the shared token in $REMOTEEXEC_TOKEN
+(a worker doesn't start without it, and `pool` generates one if it's not
+set), and only commands of allowed tools (`--allow`, compilers and protoc
+by default), that they run from their own PATH. Compiler options that run
+or load other programs (e.g. `-B`, `-fplugin`) are rejected.
+Workers listen on localhost by default.
+
+Protocol (over TCP): every message is a 4-byte big-endian header length,
+a JSON header, and the binary blobs whose sizes are listed in the header.
+  client -> worker: {version, token, args, inputs: {path: hash},
+                     outputs: [path]}
+  worker -> client: {missing: [hash]} (or {error})
+  client -> worker: {} + blob of every missing hash
+  worker -> client: {returncode, outputs: [path]} + stdout, stderr and
+                    output file blobs (or {error})
+
+`worker` runs a worker server, and `pool` runs N local workers (for tests
+and benchmarks).
+"""
+
+import SocketServer
+import hashlib
+import hmac
+import json
+import optparse
+import os
+import random
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from site_utils import proto_imports
+
+_PROTOCOL_VERSION = 2
+
+_HEADER = struct.Struct('!I')
+
+# Placeholder for the sandbox dir in remote command arguments
+_SANDBOX_MARK = '@SANDBOX@'
+
+# Maximum number of workers to try before running locally
+_MAX_ATTEMPTS = 3
+
+_CONNECT_TIMEOUT = 5.0
+_EXEC_TIMEOUT = 600.0
+
+# Environment variable with the shared token of the workers
+TOKEN_VAR = 'REMOTEEXEC_TOKEN'
+
+# Tools that workers run by default (command basenames)
+_DEFAULT_TOOLS = ('cc', 'c++', 'gcc', 'g++', 'clang', 'clang++', 'protoc')
+
+# Options (and option prefixes) that make a tool run or load other programs
+_UNSAFE_PREFIXES = ('-B', '-wrapper', '-fplugin', '-specs', '--specs',
+                    '-Xclang', '-Xlinker', '-Wl,', '-fuse-ld', '--plugin',
+                    '@')
+
+# Compiler options that take a separate value argument
+_VALUE_OPTIONS = frozenset([
+    '-o', '-MF', '-MT', '-MQ', '-include', '-imacros', '-x', '-I', '-D',
+    '-U', '-isystem', '-iquote', '-idirafter', '-include-pch', '-Xclang',
+    '-Xpreprocessor', '-arch', '-target'])
+
+# Preprocessor-only options (with separate values, or as prefixes)
+_PP_VALUE_OPTIONS = frozenset([
+    '-MF', '-MT', '-MQ', '-include', '-imacros', '-I', '-D', '-U',
+    '-isystem', '-iquote', '-idirafter', '-Xpreprocessor'])
+_PP_PREFIXES = ('-I', '-D', '-U', '-MD', '-MMD', '-MP', '-MF', '-MT', '-MQ')
+
+class ProtocolError(Exception):
+    """Remote execution protocol error."""
+    pass
+
+def send_message(sock, header, blobs=()):
+    """Send message (JSON-able header dictionary and binary blobs)."""
+    header = json.dumps(dict(header, blobs=[len(blob) for blob in blobs]))
+    sock.sendall(_HEADER.pack(len(header)) + header)
+    for blob in blobs:
+        sock.sendall(blob)
+
+def _recv_exactly(sock, size):
+    """Return exactly `size` bytes received from socket."""
+    chunks = list()
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ProtocolError('Connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+def recv_message(sock):
+    """Return received message as (header dictionary, list of blobs)."""
+    size, = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))
+    header = json.loads(_recv_exactly(sock, size))
+    blobs = [_recv_exactly(sock, blob_size)
+             for blob_size in header.pop('blobs', [])]
+    return header, blobs
+
+def content_hash(content):
+    """Return content hash of blob."""
+    return hashlib.sha1(content).hexdigest()
+
+def _is_local_path(path):
+    """Return True if path is relative and inside the current dir."""
+    path = os.path.normpath(path)
+    return not (os.path.isabs(path) or path.startswith(os.pardir))
+
+class Action(object):
+    """Remote action - command arguments, input contents, expected outputs."""
+
+    def __init__(self, args, inputs, outputs):
+        """Initialize action.
+
+        @param args     Command arguments to run on the worker
+        @param inputs   Dictionary of input path -> content
+        @param outputs  List of expected output paths
+        """
+        self.args = args
+        self.inputs = inputs
+        self.outputs = outputs
+
+def compile_action(args):
+    """Return remote Action for compile command (None if not remotable).
+
+    The source is preprocessed locally, and the worker compiles the
+     preprocessed source with the non-preprocessor options.
+    """
+    if '-c' not in args or '-include-pch' in args:
+        return None
+    sources = list()
+    output = None
+    arg_iter = iter(args[1:])
+    for arg in arg_iter:
+        if arg in _VALUE_OPTIONS:
+            value = next(arg_iter, None)
+            if '-o' == arg:
+                output = value
+        elif not arg.startswith('-'):
+            sources.append(arg)
+    if len(sources) != 1 or not output or not _is_local_path(output):
+        return None
+    # Preprocess locally (keeping depfile options, so it's written now)
+    pp_args = list()
+    arg_iter = iter(args)
+    for arg in arg_iter:
+        if '-o' == arg:
+            next(arg_iter)
+        else:
+            pp_args.append('-E' if '-c' == arg else arg)
+    proc = subprocess.Popen(pp_args, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    preprocessed, _ = proc.communicate()
+    if proc.returncode:
+        return None
+    source = sources[0]
+    is_c = source.endswith('.c')
+    pp_source = os.path.normpath(source) + ('.i' if is_c else '.ii')
+    if not _is_local_path(pp_source):
+        pp_source = os.path.basename(pp_source)
+    remote_args = [args[0]]
+    arg_iter = iter(args[1:])
+    for arg in arg_iter:
+        if arg in _PP_VALUE_OPTIONS or arg in ('-o', '-x'):
+            next(arg_iter, None)
+        elif arg == source or arg == '-c' or arg.startswith(_PP_PREFIXES):
+            continue
+        else:
+            remote_args.append(arg)
+    if any(arg.startswith('-g') for arg in args):
+        # Record the local dir (instead of the sandbox) in debug info
+        remote_args.append('-fdebug-prefix-map=%s=%s' % (_SANDBOX_MARK,
+                                                        os.getcwd()))
+    remote_args.extend(['-x', 'cpp-output' if is_c else 'c++-cpp-output',
+                        '-c', pp_source, '-o', output])
+    outputs = [output]
+    if '-gsplit-dwarf' in args:
+        outputs.append(os.path.splitext(output)[0] + '.dwo')
+    return Action(remote_args, {pp_source: preprocessed}, outputs)
+
+def protoc_action(args, outputs):
+    """Return remote Action for protoc command (None if not remotable).
+
+    The inputs are the proto sources and their transitive imports (found
+     in the proto paths). Imports that are not found (e.g. protobuf
+     well-known types) are expected to be available to protoc on the worker.
+    """
+    proto_paths = [arg.split('=', 1)[1] for arg in args
+                   if arg.startswith('--proto_path=')]
+    proto_paths.extend(arg[2:] for arg in args
+                       if arg.startswith('-I') and len(arg) > 2)
+    sources = [arg for arg in args[1:] if not arg.startswith('-')]
+    if not sources or not outputs:
+        return None
+    inputs = dict()
+    queue = list(sources)
+    while queue:
+        path = os.path.normpath(queue.pop())
+        if path in inputs:
+            continue
+        if not _is_local_path(path):
+            return None
+        try:
+            with open(path, 'rb') as proto_file:
+                inputs[path] = proto_file.read()
+        except IOError:
+            return None
+        for imp in proto_imports(inputs[path].splitlines()):
+            for proto_path in proto_paths or ['.']:
+                imp_path = os.path.join(proto_path, imp)
+                if os.path.isfile(imp_path):
+                    queue.append(imp_path)
+                    break
+    return Action(list(args), inputs, list(outputs))
+
+def describe_action(args, outputs=None):
+    """Return remote Action for command (None if it must run locally)."""
+    if outputs and not all(_is_local_path(path) for path in outputs):
+        return None
+    tool = os.path.basename(args[0])
+    if tool.startswith('protoc'):
+        return protoc_action(args, outputs)
+    return compile_action(args)
+
+def _execute_on(worker, action):
+    """Execute action on worker, return (returncode, stdout, stderr, outputs).
+
+    Raise socket.error or ProtocolError if the worker failed.
+    """
+    host, port = worker.rsplit(':', 1)
+    sock = socket.create_connection((host, int(port)), _CONNECT_TIMEOUT)
+    try:
+        sock.settimeout(_EXEC_TIMEOUT)
+        hashes = dict((path, content_hash(content))
+                      for path, content in action.inputs.iteritems())
+        send_message(sock, dict(version=_PROTOCOL_VERSION,
+                                token=os.environ.get(TOKEN_VAR, ''),
+                                args=action.args, inputs=hashes,
+                                outputs=action.outputs))
+        reply, _ = recv_message(sock)
+        if 'error' in reply:
+            raise ProtocolError(reply['error'])
+        contents = dict((hashes[path], content)
+                        for path, content in action.inputs.iteritems())
+        send_message(sock, dict(), [contents[digest]
+                                    for digest in reply['missing']])
+        result, blobs = recv_message(sock)
+        if 'error' in result:
+            raise ProtocolError(result['error'])
+    finally:
+        sock.close()
+    if len(blobs) != 2 + len(result['outputs']):
+        raise ProtocolError('Unexpected number of blobs')
+    return (result['returncode'], blobs[0], blobs[1],
+            dict(zip(result['outputs'], blobs[2:])))
+
+def _write_output(path, content):
+    """Atomically write output file."""
+    out_dir = os.path.dirname(path)
+    if out_dir and not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    tmp_path = '%s.tmp.%d' % (path, os.getpid())
+    with open(tmp_path, 'wb') as out_file:
+        out_file.write(content)
+    os.rename(tmp_path, path)
+
+def run_remote(args, workers, outputs=None):
+    """Run command on one of the workers (or locally), return exit code.
+
+    @param args     Command arguments
+    @param workers  List of worker "host:port" addresses
+    @param outputs  List of expected output paths (for non-compile commands)
+    """
+    action = describe_action(args, outputs) if workers else None
+    if action is None:
+        return subprocess.call(args)
+    candidates = list(workers)
+    random.shuffle(candidates)
+    for worker in candidates[:_MAX_ATTEMPTS]:
+        try:
+            returncode, stdout, stderr, out_files = _execute_on(worker,
+                                                                action)
+        except (socket.error, ProtocolError, ValueError, KeyError) as exc:
+            sys.stderr.write('remote_exec: worker %s failed (%s), '
+                             'retrying\n' % (worker, exc))
+            continue
+        sys.stdout.write(stdout)
+        sys.stderr.write(stderr)
+        if 0 == returncode:
+            for path, content in out_files.iteritems():
+                _write_output(path, content)
+        return returncode
+    sys.stderr.write('remote_exec: no worker available, running locally\n')
+    return subprocess.call(args)
+
+class BlobStore(object):
+    """Content-addressed store of input blobs (in a local directory)."""
+
+    def __init__(self, store_dir):
+        self._dir = store_dir
+
+    def path(self, digest):
+        """Return path of blob with content hash `digest`."""
+        return os.path.join(self._dir, digest[:2], digest)
+
+    def has(self, digest):
+        """Return True if blob is in the store."""
+        return os.path.isfile(self.path(digest))
+
+    def put(self, digest, content):
+        """Store blob (verifying its content hash)."""
+        if content_hash(content) != digest:
+            raise ProtocolError('Content hash mismatch for %s' % (digest))
+        _write_output(self.path(digest), content)
+
+    def link(self, digest, path):
+        """Create file in path with the content of blob (hard link if
+        possible)."""
+        out_dir = os.path.dirname(path)
+        if out_dir and not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        try:
+            os.link(self.path(digest), path)
+        except OSError:
+            shutil.copyfile(self.path(digest), path)
+
+def allowed_command(args, tools):
+    """Return True if command `args` runs one of `tools` (basenames),
+    without options that run or load other programs."""
+    if not args or os.path.basename(args[0]) not in tools:
+        return False
+    return not any(arg.startswith(_UNSAFE_PREFIXES) for arg in args[1:])
+
+class _WorkerServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """Worker server - handles every client in a thread, running up to
+    `jobs` commands at a time."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, work_dir, jobs, token, tools):
+        SocketServer.TCPServer.__init__(self, address, _WorkerHandler)
+        self.store = BlobStore(os.path.join(work_dir, 'blobs'))
+        self.sandbox_root = os.path.join(work_dir, 'sandbox')
+        if not os.path.isdir(self.sandbox_root):
+            os.makedirs(self.sandbox_root)
+        self.slots = threading.Semaphore(jobs)
+        self.token = token
+        self.tools = frozenset(tools)
+
+    def authorized(self, request):
+        """Return True if request has the worker token."""
+        return hmac.compare_digest(
+            request.get('token', u'').encode('utf-8'), self.token)
+
+    def execute(self, request):
+        """Execute request in a sandbox, return (result, blobs)."""
+        sandbox = tempfile.mkdtemp(dir=self.sandbox_root)
+        try:
+            for path, digest in request['inputs'].iteritems():
+                self.store.link(digest, os.path.join(sandbox, path))
+            for path in request['outputs']:
+                out_dir = os.path.dirname(os.path.join(sandbox, path))
+                if not os.path.isdir(out_dir):
+                    os.makedirs(out_dir)
+            args = [arg.encode('utf-8').replace(_SANDBOX_MARK, sandbox)
+                    for arg in request['args']]
+            # Run the allowed tool from the worker PATH
+            args[0] = os.path.basename(args[0])
+            try:
+                proc = subprocess.Popen(args, cwd=sandbox,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE)
+            except OSError as exc:
+                return dict(error='Failed running %s: %s' % (args[0], exc)), []
+            stdout, stderr = proc.communicate()
+            outputs = list()
+            blobs = [stdout, stderr]
+            if 0 == proc.returncode:
+                for path in request['outputs']:
+                    out_path = os.path.join(sandbox, path)
+                    if os.path.isfile(out_path):
+                        with open(out_path, 'rb') as out_file:
+                            blobs.append(out_file.read())
+                        outputs.append(path)
+            return dict(returncode=proc.returncode, outputs=outputs), blobs
+        finally:
+            shutil.rmtree(sandbox, ignore_errors=True)
+
+class _WorkerHandler(SocketServer.BaseRequestHandler):
+    """Worker request handler - executes one action per connection."""
+
+    def handle(self):
+        sock = self.request
+        try:
+            request, _ = recv_message(sock)
+        except (socket.error, ProtocolError):
+            # Closed without a request (e.g. a readiness probe)
+            return
+        try:
+            if request.get('version') != _PROTOCOL_VERSION:
+                send_message(sock, dict(error='Unsupported protocol version'))
+                return
+            if not self.server.authorized(request):
+                send_message(sock, dict(error='Invalid token'))
+                return
+            if not allowed_command(request['args'], self.server.tools):
+                send_message(sock, dict(error='Command not allowed'))
+                return
+            paths = request['inputs'].keys() + request['outputs']
+            if not all(_is_local_path(path) for path in paths):
+                send_message(sock, dict(error='Invalid path'))
+                return
+            missing = sorted(set(digest for digest in
+                                 request['inputs'].itervalues()
+                                 if not self.server.store.has(digest)))
+            send_message(sock, dict(missing=missing))
+            _, blobs = recv_message(sock)
+            if len(blobs) != len(missing):
+                raise ProtocolError('Unexpected number of blobs')
+            for digest, content in zip(missing, blobs):
+                self.server.store.put(digest, content)
+            with self.server.slots:
+                result, blobs = self.server.execute(request)
+            send_message(sock, result, blobs)
+        except (socket.error, ProtocolError, ValueError, KeyError) as exc:
+            sys.stderr.write('worker: request failed (%s)\n' % (exc))
+
+def serve_worker(host, port, work_dir, jobs, token, tools=_DEFAULT_TOOLS):
+    """Run a worker server (forever).
+
+    @param token    Shared token that requests must have
+    @param tools    Command basenames that the worker runs
+    """
+    server = _WorkerServer((host, port), work_dir, jobs, token, tools)
+    print 'Worker listening on %s:%d (%d jobs, work dir %s)' % (
+        host, server.server_address[1], jobs, work_dir)
+    sys.stdout.flush()
+    server.serve_forever()
+
+def start_pool(num_workers, base_port, jobs, work_dir, host='127.0.0.1'):
+    """Start local worker processes, return (processes, worker addresses).
+
+    The workers use the token in $REMOTEEXEC_TOKEN, that is generated (and
+     set in this process environment, for the commands it runs) if missing.
+    """
+    if not os.environ.get(TOKEN_VAR):
+        os.environ[TOKEN_VAR] = os.urandom(16).encode('hex')
+    procs = list()
+    workers = list()
+    for idx in xrange(num_workers):
+        port = base_port + idx
+        procs.append(subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), 'worker',
+             '--host=%s' % (host), '--port=%d' % (port),
+             '--jobs=%d' % (jobs),
+             '--dir=%s' % (os.path.join(work_dir, 'worker%d' % (idx)))]))
+        workers.append('%s:%d' % (host, port))
+    # Wait for the workers to listen
+    for worker in workers:
+        for _ in xrange(50):
+            try:
+                socket.create_connection(worker.split(':'), 0.1).close()
+                break
+            except socket.error:
+                time.sleep(0.1)
+    return procs, workers
+
+def main():
+    """Run a command remotely, or run a worker / local worker pool."""
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    parser = optparse.OptionParser(
+        usage='usage: %prog run|worker|pool [options] [-- COMMAND ARGS...]')
+    parser.disable_interspersed_args()
+    parser.add_option('--workers', default='',
+                      help='run: comma-separated worker addresses '
+                      '(host:port); pool: number of workers')
+    parser.add_option('--output', action='append', default=[],
+                      help='run: expected output path (repeatable)')
+    parser.add_option('--host', default='127.0.0.1',
+                      help='worker / pool: address to listen on [%default]')
+    parser.add_option('--port', type='int', default=8378,
+                      help='worker: port to listen on [%default]')
+    parser.add_option('--base-port', type='int', default=8378,
+                      help='pool: port of the first worker [%default]')
+    parser.add_option('--jobs', type='int', default=4,
+                      help='worker / pool: parallel jobs per worker '
+                      '[%default]')
+    parser.add_option('--dir', default=None,
+                      help='worker / pool: work dir [temp dir]')
+    parser.add_option('--allow', default=','.join(_DEFAULT_TOOLS),
+                      help='worker: comma-separated tools (command '
+                      'basenames) to run [%default]')
+    opts, args = parser.parse_args(sys.argv[2:])
+    if 'run' == command:
+        if not args:
+            parser.error('Missing command')
+        workers = [worker for worker in opts.workers.split(',') if worker]
+        sys.exit(run_remote(args, workers, opts.output))
+    work_dir = opts.dir or tempfile.mkdtemp(prefix='remote_exec.')
+    if 'worker' == command:
+        if not os.environ.get(TOKEN_VAR):
+            parser.error('Missing shared token in $%s' % (TOKEN_VAR))
+        serve_worker(opts.host, opts.port, work_dir, opts.jobs,
+                     os.environ[TOKEN_VAR],
+                     [tool for tool in opts.allow.split(',') if tool])
+    elif 'pool' == command:
+        procs, workers = start_pool(int(opts.workers or 4), opts.base_port,
+                                    opts.jobs, work_dir, opts.host)
+        print 'REMOTEEXEC_WORKERS=%s' % (','.join(workers))
+        print '%s=%s' % (TOKEN_VAR, os.environ[TOKEN_VAR])
+        sys.stdout.flush()
+        try:
+            for proc in procs:
+                proc.wait()
+        except KeyboardInterrupt:
+            for proc in procs:
+                proc.terminate()
+    else:
+        parser.error('Unknown command "%s"' % (command))
+
+if '__main__' == __name__:
+    main()
@@ -5,13 +5,59 @@
 
 import os
 
-from site_utils import module_dirs_generator
-
 # Directory for build process outputs (object files etc.)
 _BUILD_BASE = 'build'
 # Directory where binary programs are installed in (under $build_base/$flavor)
 _BIN_SUBDIR = 'bin'
 
+# Persistent module discovery index file (None to walk the tree every time)
+_MODULES_INDEX = os.path.join(_BUILD_BASE, '.modules_index')
+
+# Strategy for reading module SConscript files:
+#  'declarative' - read every SConscript once per run, recording the shortcut
+#                  calls it makes, and instantiate them for every flavor
+#  'single-pass' - read every SConscript once per flavor, deferring program
+#                  targets until every library is known
+#  'two-pass'    - read every SConscript twice per flavor (libraries, then
+#                  programs)
+SCONSCRIPT_READ_MODE = 'declarative'
+
+# Persistent manifest of module targets, used in 'declarative' mode to load
+#  only the modules needed for the command line targets (None to always
+#  load all modules)
+MODULES_MANIFEST = os.path.join(_BUILD_BASE, '.modules_manifest')
+
+# Persistent action durations file, used to start actions on the critical
+#  path first (None to keep the default SCons order), e.g.
+#  os.path.join(_BUILD_BASE, '.action_durations')
+ACTION_DURATIONS = None
+
+# Directory for build graph snapshots, used to skip reading SConscripts
+#  on null builds (None to always read them)
+GRAPH_SNAPSHOT_DIR = os.path.join(_BUILD_BASE, '.graph_snapshots')
+
+# Path prefix of the per-run object cache stats files (suffixed by the
+#  SCons process ID)
+OBJCACHE_STATS = os.path.join(_BUILD_BASE, '.objcache_stats')
+
+# Link strategies, selected per flavor with LINK_STRATEGY (see
+#  site_tools/linkstrategy.py), e.g. LINK_STRATEGY = 'fast' in the debug
+#  flavor ENV_OVERRIDES
+LINK_STRATEGIES = {
+    # Fast edit-relink cycle (for debug builds), needs a toolchain with
+    #  thin archives and split DWARF (and lld or gold for the gdb index)
+    'fast': dict(
+        # Static libraries are thin archives (referencing their objects)
+        THIN_ARCHIVES = True,
+        # Debug info goes to .dwo files, instead of being linked
+        SPLIT_DWARF   = True,
+        # Preferred linkers (first found is used, default linker if none)
+        LINKERS       = ['lld', 'gold'],
+        # Build gdb index at link time (with lld / gold)
+        GDB_INDEX     = True,
+    ),
+}
+
 # List of cached modules to save processing for second call and beyond
 _CACHED_MODULES = list()
 
@@ -21,6 +67,8 @@ def modules():
     Each module is a directory with a SConscript file.
     """
     if not _CACHED_MODULES:
+        # Imported here, so config queries (see main) don't import site_utils
+        from site_utils import module_dirs_generator
         # Build the cache
         def build_dir_skipper(dirpath):
             """Return True if `dirpath` is the build base dir."""
@@ -32,7 +80,8 @@ def modules():
         for module_path in module_dirs_generator(
                 max_depth=7, followlinks=False,
                 dir_skip_list=[build_dir_skipper, hidden_dir_skipper],
-                file_skip_list='.noscons'):
+                file_skip_list='.noscons', index_path=_MODULES_INDEX,
+                index_key=os.path.getmtime(__file__)):
             _CACHED_MODULES.append(module_path)
     # Yield modules from cache
     for module in _CACHED_MODULES:
@@ -48,9 +97,44 @@ ENV_OVERRIDES = {
         CXX         = 'clang++',
         # Path for installed binary programs
         BINDIR      = os.path.join('$BUILDROOT', _BIN_SUBDIR),
+        # Shared root for flavor-independent generated code (e.g. protoc
+        #  outputs), generated once for all flavors ('' for per-flavor)
+        GENROOT     = os.path.join(_BUILD_BASE, '_gen'),
+        # Persistent proto imports cache, shared by all flavors
+        PROTOCSCANCACHE = os.path.join(_BUILD_BASE, '.protoc_scan_cache'),
+        # Shared object cache directory (e.g. ~/.cache/ostrich-objcache),
+        #  its maximum size, and an optional HTTP cache server URL (the
+        #  object cache is enabled if either is set)
+        OBJCACHE_DIR      = '',
+        OBJCACHE_MAX_SIZE = '5G',
+        OBJCACHE_URL      = '',
+        # Comma-separated remote execution workers (host:port) to run compile
+        #  and protoc actions on ('' to run them locally), e.g. from
+        #  `python site_scons/remote_exec.py pool`
+        REMOTEEXEC_WORKERS = os.environ.get('REMOTEEXEC_WORKERS', ''),
+        # Get C/C++ dependencies from compiler-generated depfiles, instead
+        #  of scanning sources and headers (falling back to scanning for
+        #  objects without a depfile)
+        DEPFILES          = False,
+        # Unity builds - compile library C++ sources in batches of up to
+        #  UNITY_MAX_SOURCES sources per translation unit (can be overridden
+        #  per flavor, or per library, e.g. `Lib(..., UNITY_BUILD=True)`)
+        UNITY_BUILD       = False,
+        UNITY_MAX_SOURCES = 8,
+        # Sources to exclude from unity builds (protobuf 3 generated sources
+        #  define file-static tables with the same names)
+        UNITY_EXCLUDE     = ['*.pb.cc'],
+        # How programs are installed in BINDIR - 'copy', or 'hardlink',
+        #  'reflink' (copy-on-write clone) or 'symlink' to skip copying
+        #  (copying when the mode isn't supported, e.g. across devices).
+        #  With 'hardlink' or 'symlink', editing an installed file edits
+        #  the build output too
+        INSTALL_MODE      = 'copy',
+        # Link strategy (key of LINK_STRATEGIES, None for the default)
+        LINK_STRATEGY     = None,
     ),
     'debug': dict(
-        BUILDROOT = os.path.join(_BUILD_BASE, 'debug'),
+        BUILDROOT     = os.path.join(_BUILD_BASE, 'debug'),
     ),
     'release': dict(
         BUILDROOT = os.path.join(_BUILD_BASE, 'release'),
@@ -65,7 +149,9 @@ ENV_EXTENSIONS = {
         # Common flags for all C++ builds
         CCFLAGS = ['-std=c++11', '-Wall', '-fvectorize', '-fslp-vectorize'],
         # Modules should be able to include relative to build root dir
-        CPPPATH = ['#$BUILDROOT'],
+        #  (and to the shared generated code root, which comes first,
+        #  so it takes precedence over stale per-flavor generated files)
+        CPPPATH = ['#$GENROOT', '#$BUILDROOT'],
     ),
     'debug': dict(
         # Extra flags for debug C++ builds
@@ -91,23 +177,100 @@ def flavors():
         if not flavor.startswith('_'):
             yield flavor
 
+# Shell variable names of config queries (in `--shell` output)
+_QUERY_VARS = dict(
+    flavors     = 'FLAVORS',
+    modules     = 'MODULES',
+    build       = 'BUILD_SUBDIR',
+    build_dir   = 'BUILD_SUBDIR',
+    build_base  = 'BUILD_SUBDIR',
+    bin         = 'BIN_SUBDIR',
+    bin_subdir  = 'BIN_SUBDIR',
+)
+
+def query(var):
+    """Return list of values of a config query (None if unknown)."""
+    var = var.lower()
+    if var in ('flavors',):
+        return list(flavors())
+    elif var in ('modules',):
+        return list(modules())
+    elif var in ('build', 'build_dir', 'build_base'):
+        return [_BUILD_BASE]
+    elif var in ('bin', 'bin_subdir'):
+        return [_BIN_SUBDIR]
+    return None
+
+def _cache_key(queries):
+    """Return cache key line for queries (config scripts mtimes)."""
+    site_dir = os.path.dirname(os.path.abspath(__file__))
+    mtimes = [os.path.getmtime(os.path.join(site_dir, script))
+              for script in ('site_config.py', 'site_utils.py')]
+    return '# site_config cache: %r %s\n' % (mtimes, ' '.join(queries))
+
+def shell_output(queries):
+    """Return shell-evaluable assignments of config queries values."""
+    import pipes
+    lines = list()
+    for var in queries:
+        values = query(var)
+        if values is not None and var.lower() in _QUERY_VARS:
+            lines.append('%s=%s\n' % (_QUERY_VARS[var.lower()],
+                                       pipes.quote(' '.join(values))))
+    return ''.join(lines)
+
 def main():
-    """Main procedure - print out a requested variable (value per line)"""
+    """Main procedure - print out requested variables.
+
+    usage: python site_config.py QUERY
+           python site_config.py --shell [--cache=FILE] QUERY...
+
+    With one query, print its values (value per line).
+    With `--shell`, print shell variable assignments for all the queries
+     (e.g. `BUILD_SUBDIR=build`), to be evaluated by a shell.
+    With `--cache=FILE`, the shell output is also written to FILE, with the
+     mtimes of the config scripts, and reused while they don't change.
+     FILE can be sourced by a shell directly (e.g. by the `mode` script,
+     if it's newer than the config scripts), without starting Python.
+    """
+    import optparse
     import sys
-    if 2 == len(sys.argv):
-        var = sys.argv[1].lower()
-        items = list()
-        if var in ('flavors',):
-            items = flavors()
-        elif var in ('modules',):
-            items = modules()
-        elif var in ('build', 'build_dir', 'build_base'):
-            items = [_BUILD_BASE]
-        elif var in ('bin', 'bin_subdir'):
-            items = [_BIN_SUBDIR]
-        # print out the item values
-        for val in items:
-            print val
+    parser = optparse.OptionParser(
+        usage='usage: %prog [--shell] [--cache=FILE] QUERY...')
+    parser.add_option('--shell', action='store_true', default=False,
+                      help='Print shell variable assignments')
+    parser.add_option('--cache', default='',
+                      help='Shell output cache file (implies --shell)')
+    opts, queries = parser.parse_args()
+    if not (opts.shell or opts.cache):
+        if 1 == len(queries):
+            # print out the item values
+            for val in query(queries[0]) or []:
+                print val
+        return
+    key = _cache_key(queries)
+    if opts.cache:
+        try:
+            with open(opts.cache) as cache_file:
+                content = cache_file.read()
+            if content.startswith(key):
+                sys.stdout.write(content[len(key):])
+                return
+        except IOError:
+            pass
+    output = shell_output(queries)
+    if opts.cache:
+        tmp_path = '%s.%d' % (opts.cache, os.getpid())
+        try:
+            cache_dir = os.path.dirname(opts.cache)
+            if cache_dir and not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            with open(tmp_path, 'w') as cache_file:
+                cache_file.write(key + output)
+            os.rename(tmp_path, opts.cache)
+        except (IOError, OSError):
+            sys.stderr.write('Failed writing config cache %s\n' % (opts.cache))
+    sys.stdout.write(output)
 
 if '__main__' == __name__:
     main()
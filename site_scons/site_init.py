@@ -3,21 +3,58 @@
 
 """SCons site init script - automatically imported by SConstruct"""
 
+import atexit
+import fnmatch
+import glob
 import os
-from collections import defaultdict
+import sys
+import time
+from collections import defaultdict, OrderedDict
 
 import SCons
 from SCons import Node
 from SCons.Errors import StopError
 
-from site_config import flavors, modules, ENV_OVERRIDES, ENV_EXTENSIONS
-from site_utils import listify, path_to_key, nop, sprint
+from site_config import (flavors, modules, ENV_OVERRIDES, ENV_EXTENSIONS,
+                         SCONSCRIPT_READ_MODE, GRAPH_SNAPSHOT_DIR,
+                         MODULES_MANIFEST, ACTION_DURATIONS, OBJCACHE_STATS,
+                         LINK_STRATEGIES)
+from site_utils import (listify, path_to_key, nop, sprint, LibraryRegistry,
+                        ModuleManifest)
+from build_profiler import profiler
+from critical_path import scheduler
+from graph_snapshot import GraphSnapshot
+from parallel_flavors import (build_flavors, flavor_sconsign,
+                              is_flavor_process)
+import object_cache
+import remote_exec
+
+AddOption('--profile-build', dest='profile_build', metavar='FILE',  # pylint: disable=undefined-variable
+          help='Write build profile (Chrome trace-event JSON) to FILE.')
+AddOption('--critical-path-report', dest='critical_path_report',  # pylint: disable=undefined-variable
+          action='store_true', default=False,
+          help='Print estimated and actual critical paths of the build '
+          '(with ACTION_DURATIONS set in site_config).')
+AddOption('--parallel-flavors', dest='parallel_flavors',  # pylint: disable=undefined-variable
+          action='store_true', default=False,
+          help='Build every selected flavor in its own SCons process.')
 
 def get_base_env(*args, **kwargs):
     """Initialize and return a base construction environment.
 
     All args received are passed transparently to SCons Environment init.
     """
+    if GetOption('profile_build'):  # pylint: disable=undefined-variable
+        profiler.enable(GetOption('profile_build'))  # pylint: disable=undefined-variable
+    if ACTION_DURATIONS and not (GetOption('no_exec') or  # pylint: disable=undefined-variable
+                                 GetOption('question')):  # pylint: disable=undefined-variable
+        # Flavor build processes keep their own action durations
+        durations_path = ('%s.%s' % (ACTION_DURATIONS,
+                                     os.environ['BUILD_FLAVOR'])
+                          if is_flavor_process() else ACTION_DURATIONS)
+        scheduler.enable(durations_path,
+                         report=GetOption('critical_path_report'))  # pylint: disable=undefined-variable
+    start_time = time.time()
     # Initialize new construction environment
     env = Environment(*args, **kwargs)  # pylint: disable=undefined-variable
     # If a flavor is activated in the external environment - use it
@@ -38,8 +75,454 @@ def get_base_env(*args, **kwargs):
         env.Replace(**ENV_OVERRIDES['_common'])
     if '_common' in ENV_EXTENSIONS:
         env.Append(**ENV_EXTENSIONS['_common'])
+    # Flavor build processes (see parallel_flavors.py) keep their own
+    #  signatures database
+    if is_flavor_process():
+        env.SConsignFile(flavor_sconsign(os.environ['BUILD_FLAVOR']))
+    # Install programs by INSTALL_MODE (hard links, reflinks, ...)
+    env.Tool('installmode')
+    # Get C/C++ dependencies from compiler depfiles (if enabled)
+    if env.get('DEPFILES'):
+        env.Tool('depfiles')
+    # Compile through the shared object cache (if enabled)
+    if env.get('OBJCACHE_DIR') or env.get('OBJCACHE_URL'):
+        enable_object_cache(env)
+    # Run compile and protoc actions on remote workers (if configured)
+    if env.get('REMOTEEXEC_WORKERS'):
+        enable_remote_exec(env)
+    # Share flavor-independent generated code between flavors (if enabled),
+    #  flavor build processes use the code generated before they started
+    env.codegen = (SharedCodegen(env, prebuilt=is_flavor_process())
+                   if env.get('GENROOT') else None)
+    profiler.add_span('get_base_env', 'config', start_time, time.time())
     return env
 
+def enable_object_cache(env):
+    """Prefix compile commands in env with the object cache wrapper.
+
+    The wrapper (see object_cache.py) is excluded from build signatures,
+     so enabling or reconfiguring the cache doesn't trigger rebuilds.
+    Cache hit / miss statistics of this run are printed at exit.
+    """
+    env.SetDefault(OBJCACHE_MAX_SIZE='0', OBJCACHE_URL='',
+                   REMOTEEXEC_WORKERS='')
+    env['OBJCACHE_STATS'] = env.File(
+        '#%s.%d' % (OBJCACHE_STATS, os.getpid())).abspath
+    env['OBJCACHE_CMD'] = [
+        sys.executable, os.path.splitext(object_cache.__file__)[0] + '.py',
+        '--dir=$OBJCACHE_DIR', '--max-size=$OBJCACHE_MAX_SIZE',
+        '--url=$OBJCACHE_URL', '--stats=$OBJCACHE_STATS',
+        '--remote-workers=$REMOTEEXEC_WORKERS', '--']
+    for com_var in ('CCCOM', 'CXXCOM', 'SHCCCOM', 'SHCXXCOM'):
+        if com_var in env:
+            env[com_var] = '$( $OBJCACHE_CMD $) ' + env[com_var]
+    if not GetOption('no_exec'):  # pylint: disable=undefined-variable
+        for objcache_dir in (env.subst('$OBJCACHE_DIR'),
+                             os.path.dirname(env['OBJCACHE_STATS'])):
+            if objcache_dir and not os.path.isdir(objcache_dir):
+                os.makedirs(objcache_dir)
+        atexit.register(object_cache.report_stats, env['OBJCACHE_STATS'])
+        if profiler.enabled:
+            profiler.track_object_cache(env['OBJCACHE_STATS'])
+
+def enable_remote_exec(env):
+    """Prefix compile and protoc commands in env with the remote executor.
+
+    The executor (see remote_exec.py) runs the commands on the workers in
+     $REMOTEEXEC_WORKERS, falling back to running locally.
+    Like the object cache wrapper, it is excluded from build signatures.
+    With the object cache enabled, the cache wrapper runs compiles that miss
+     the cache with the executor.
+    The shared token of the workers ($REMOTEEXEC_TOKEN in the environment)
+     is passed to the executor in the action environment.
+    """
+    env['ENV'][remote_exec.TOKEN_VAR] = os.environ.get(remote_exec.TOKEN_VAR,
+                                                       '')
+    env['REMOTEEXEC_CMD'] = [
+        sys.executable, os.path.splitext(remote_exec.__file__)[0] + '.py',
+        'run', '--workers=$REMOTEEXEC_WORKERS']
+    # protoc outputs are the targets (compile outputs are in the command)
+    env['_REMOTEEXEC_OUTPUTS'] = '${["--output=%s" % (x) for x in TARGETS]}'
+    if 'PROTOCOM' in env:
+        env['PROTOCOM'] = ('$( $REMOTEEXEC_CMD $_REMOTEEXEC_OUTPUTS -- $) ' +
+                           env['PROTOCOM'])
+    if 'OBJCACHE_CMD' not in env:
+        for com_var in ('CCCOM', 'CXXCOM', 'SHCCCOM', 'SHCXXCOM'):
+            if com_var in env:
+                env[com_var] = '$( $REMOTEEXEC_CMD -- $) ' + env[com_var]
+
+def discover_modules():
+    """Return list of modules to build (recording discovery time)."""
+    with profiler.span('module discovery', 'discovery'):
+        return list(modules())
+
+def graph_snapshot():
+    """Return graph snapshot for this invocation (None if not applicable).
+
+    The snapshot context is the active flavor from the environment, the
+     command line targets, the launch dir and the climb up option (`-u`,
+     `-U`, `-D` - that select default targets by the launch dir), and
+     whether this is a flavor build process (with its own signatures
+     database), and its configuration fingerprint covers
+     SConstruct, site_scons scripts, and every module SConscript.
+    """
+    if not GRAPH_SNAPSHOT_DIR:
+        return None
+    for option in ('clean', 'no_exec', 'question', 'profile_build'):
+        if GetOption(option):  # pylint: disable=undefined-variable
+            return None
+    with profiler.span('graph snapshot', 'config'):
+        site_dir = os.path.dirname(os.path.abspath(__file__))
+        config_paths = (
+            ['SConstruct'] +
+            sorted(glob.glob(os.path.join(site_dir, '*.py'))) +
+            sorted(glob.glob(os.path.join(site_dir, 'site_tools', '*.py'))) +
+            [os.path.join(module, 'SConscript')
+             for module in discover_modules()])
+        # pylint: disable=undefined-variable
+        context = (os.environ.get('BUILD_FLAVOR'),
+                   sorted(COMMAND_LINE_TARGETS),
+                   GetLaunchDir(), GetOption('climb_up'),
+                   is_flavor_process())
+        return GraphSnapshot(GRAPH_SNAPSHOT_DIR, context, config_paths)
+
+def parallel_flavors():
+    """Return flavors to build in parallel processes (None to build in
+    this process).
+
+    Flavors are built in parallel processes with `--parallel-flavors`, if
+     no flavor is active in the environment, more than one flavor is
+     selected, and the command line targets are only flavor names (other
+     targets can't be assigned to flavor processes).
+    With `-u` / `-U` in a sub-directory (building only its targets),
+     flavors are built in this process too.
+    """
+    if not GetOption('parallel_flavors') or 'BUILD_FLAVOR' in os.environ:  # pylint: disable=undefined-variable
+        return None
+    if (GetOption('climb_up') in (1, 3) and  # pylint: disable=undefined-variable
+            GetLaunchDir() != Dir('#').abspath):  # pylint: disable=undefined-variable
+        sprint('Building flavors in this process (-u / -U in a '
+               'sub-directory)')
+        return None
+    all_flavors = sorted(flavors())
+    if any(target not in all_flavors for target in COMMAND_LINE_TARGETS):  # pylint: disable=undefined-variable
+        sprint('Building flavors in this process (non-flavor targets given)')
+        return None
+    selected = [flavor for flavor in all_flavors
+                if flavor in COMMAND_LINE_TARGETS] or all_flavors  # pylint: disable=undefined-variable
+    return selected if len(selected) > 1 else None
+
+def build_parallel_flavors(selected_flavors):
+    """Build flavors in parallel SCons processes, return exit status.
+
+    Shared generated code (under $GENROOT) is generated first, by a single
+     SCons process, so the flavor processes don't generate it concurrently.
+    """
+    return build_flavors(selected_flavors, GetOption('num_jobs'),  # pylint: disable=undefined-variable
+                         sorted(flavors()),
+                         ENV_OVERRIDES.get('_common', {}).get('GENROOT'))
+
+class SharedCodegen(object):
+    """Flavor-independent code generation targets, shared by all flavors.
+
+    Generated code doesn't depend on the flavor, so code generators run once
+     for all flavors under $GENROOT, instead of once per flavor under
+     $BUILDROOT of each flavor.
+    """
+
+    def __init__(self, base_env, prebuilt=False):
+        """Initialize shared codegen manager.
+
+        @param base_env     Basic construction environment to start from
+        @param prebuilt     True if the code is generated by another process
+                            (see parallel_flavors.py) - the generated nodes
+                            are then source files, without builders
+        """
+        # Codegen env is the base env, with $GENROOT as its build root
+        self._env = base_env.Clone(BUILDROOT='$GENROOT')
+        self.root = self._env.Dir('#$GENROOT')
+        self._prebuilt = prebuilt
+        # Cached generated nodes (by codegen call)
+        self._targets = dict()
+
+    def protoc(self, module, rel_dir, sources, kwargs):
+        """Return generated nodes for Protoc call (creating them once).
+
+        @param module       Module name
+        @param rel_dir      Directory the call was made from, relative to
+                            the build root
+        @param sources      List of proto file paths (relative to `rel_dir`)
+        @param kwargs       Keyword arguments of the Protoc call
+        """
+        call_key = (rel_dir, tuple(sources), repr(sorted(kwargs.iteritems())))
+        if call_key not in self._targets and self._prebuilt:
+            # Name the generated nodes like the Protoc builder would
+            call_env = self._env.Override(kwargs)
+            proto_suffix = call_env.subst('$PROTOCSRCSUFFIX')
+            protos = [
+                self.root.Dir(rel_dir).File(
+                    SCons.Util.adjustixes(source, '', proto_suffix))
+                for source in sources]
+            self._targets[call_key] = call_env['BUILDERS']['Protoc'].emitter(
+                [], protos, call_env)[0]
+        elif call_key not in self._targets:
+            self._env.VariantDir(os.path.join('#$GENROOT', module),
+                                 os.path.join('#', module))
+            self._targets[call_key] = call_in_dir(
+                self._env, self.root.Dir(rel_dir),
+                self._env.Protoc, ([], sources), kwargs)
+        return self._targets[call_key]
+
+# Names of the shortcuts available in module SConscript files
+_SHORTCUT_NAMES = ('Lib', 'StaticLib', 'SharedLib', 'Protoc', 'Pch', 'Prog')
+
+# Order of declaration instantiation by shortcut name (others come last)
+_DECLARATION_ORDER = dict(Protoc=0, Pch=1)
+
+# Dictionary of cached module -> declarations, to read modules once per run
+_CACHED_DECLARATIONS = dict()
+
+# List of modules selected for this run (see `selected_modules`)
+_SELECTED_MODULES = list()
+
+def read_sconscript(env, module, shortcuts, variant_dir=None, phase=None):
+    """Read the SConscript of module with shortcuts in its globals.
+
+    @param env          Construction environment to read SConscript with
+    @param module       Module name
+    @param shortcuts    Dictionary of shortcuts to make available
+    @param variant_dir  Variant dir to read module SConscript in (if any)
+    @param phase        Description of reading phase (for profiling)
+    """
+    # Verify the SConscript file exists
+    sconscript_path = os.path.join(module, 'SConscript')
+    if not os.path.isfile(sconscript_path):
+        raise StopError('Missing SConscript file for module %s.' % (module))
+    SCons.Script._SConscript.GlobalDict.update(shortcuts)  # pylint: disable=protected-access
+    with profiler.span('SConscript %s' % (module), 'sconscript',
+                       phase=phase):
+        if variant_dir:
+            env.SConscript(sconscript_path, variant_dir=variant_dir)
+        else:
+            env.SConscript(sconscript_path)
+
+def call_in_dir(env, dir_node, func, args, kwargs):
+    """Call func(*args, **kwargs) with `dir_node` as current SCons dir.
+
+    This makes relative paths passed to builders resolve as if the call
+     was made from a SConscript read in `dir_node`.
+    """
+    prev_dir = env.fs.getcwd()
+    env.fs.chdir(dir_node, change_os_dir=0)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        env.fs.chdir(prev_dir, change_os_dir=0)
+
+def module_declarations(env):
+    """Return list of (module, declarations) pairs for selected modules.
+
+    A declaration is a (shortcut name, args, kwargs) tuple that records
+     a shortcut call (`Lib`, `Prog`, `Protoc` etc.) in a module SConscript.
+    Declarations don't depend on the flavor, so every module SConscript is
+     read once per run (not in a variant dir), and the declarations are
+     instantiated for every flavor.
+    """
+    return [(module, _read_declarations(env, module))
+            for module in selected_modules(env)]
+
+def _read_declarations(env, module):
+    """Return declarations of module (reading its SConscript once)."""
+    if module not in _CACHED_DECLARATIONS:
+        sprint('|- Reading module %s ...', module)
+        declarations = list()
+        shortcuts = dict(
+            (name, _declaration_recorder(name, module, declarations))
+            for name in _SHORTCUT_NAMES)
+        read_sconscript(env, module, shortcuts, phase='declarations')
+        _CACHED_DECLARATIONS[module] = declarations
+    return _CACHED_DECLARATIONS[module]
+
+def selected_modules(env):
+    """Return list of modules needed for the command line targets.
+
+    With a modules manifest (MODULES_MANIFEST), if every command line target
+     is a path that belongs to a module, only these modules and the modules
+     they depend on (by `with_libs`) are selected, and other SConscripts
+     are read only if the manifest has no up-to-date entries for them.
+    Otherwise, all modules are selected.
+    """
+    if _SELECTED_MODULES:
+        return _SELECTED_MODULES
+    all_modules = discover_modules()
+    _SELECTED_MODULES.extend(all_modules)
+    if not MODULES_MANIFEST or not COMMAND_LINE_TARGETS:  # pylint: disable=undefined-variable
+        return _SELECTED_MODULES
+    with profiler.span('module selection', 'discovery'):
+        manifest = ModuleManifest(MODULES_MANIFEST, FlavorBuilder._key_sep)  # pylint: disable=protected-access
+        for module in all_modules:
+            if manifest.get(module) is None:
+                manifest.set(module, _manifest_entries(
+                    _read_declarations(env, module)))
+        manifest.save()
+        target_modules = set()
+        for target in COMMAND_LINE_TARGETS:  # pylint: disable=undefined-variable
+            modules_of_target = _target_modules(env, manifest, all_modules,
+                                                target)
+            if not modules_of_target:
+                return _SELECTED_MODULES
+            target_modules.update(modules_of_target)
+        needed_modules = manifest.closure(target_modules)
+    del _SELECTED_MODULES[:]
+    _SELECTED_MODULES.extend(module for module in all_modules
+                             if module in needed_modules)
+    sprint('|- Loading %d of %d modules needed for targets',
+           len(_SELECTED_MODULES), len(all_modules))
+    return _SELECTED_MODULES
+
+def _manifest_entries(declarations):
+    """Return module manifest entries summarizing module declarations."""
+    entries = list()
+    for shortcut_name, args, kwargs in declarations:
+        if shortcut_name in ('Protoc', 'Pch'):
+            entries.append((shortcut_name, None, []))
+            continue
+        with_libs = kwargs.get('with_libs', args[2] if len(args) > 2 else None)
+        entries.append((shortcut_name, args[0] if args else None,
+                        listify(with_libs)))
+    return entries
+
+def _target_modules(env, manifest, all_modules, target):
+    """Return list of modules that command line `target` belongs to.
+
+    Paths under a flavor bin dir belong to the module of the installed
+     program, and other paths (under a flavor build root, the generated
+     code root, or the project dir) belong to the module that contains them.
+    Return an empty list if the target doesn't belong to specific modules
+     (e.g. a flavor name, or the build root itself).
+    """
+    top_dir = env.Dir('#').abspath
+    path = os.path.relpath(os.path.abspath(target), top_dir)
+    if path.startswith(os.pardir) or GetOption('climb_up'):  # pylint: disable=undefined-variable
+        return []
+    roots = [env.subst('$GENROOT')] if env.get('GENROOT') else []
+    for flavor in flavors():
+        flavor_env = env.Override(ENV_OVERRIDES.get(flavor, {}))
+        bin_dir = os.path.normpath(flavor_env.subst('$BINDIR'))
+        if path.startswith(bin_dir + os.sep):
+            bin_name = path[len(bin_dir) + 1:].split(os.sep)[0]
+            return [module for module in all_modules
+                    for shortcut_name, prog_name, _ in manifest.entries(module)
+                    if 'Prog' == shortcut_name and prog_name and bin_name ==
+                    path_to_key('%s.%s' % (module, os.path.basename(
+                        prog_name)))]
+        roots.append(flavor_env.subst('$BUILDROOT'))
+    for root in roots:
+        root = os.path.normpath(root)
+        if path.startswith(root + os.sep):
+            path = path[len(root) + 1:]
+            break
+    for module in sorted(all_modules, key=len, reverse=True):
+        if path == module or path.startswith(module + os.sep):
+            return [module]
+    return []
+
+def _declaration_recorder(shortcut_name, module, declarations):
+    """Return a shortcut function that records its calls as declarations.
+
+    @param  shortcut_name   Name of the recorded shortcut
+    @param  module          Module name
+    @param  declarations    List to append recorded declarations to
+    """
+    module_dir = SCons.Script.Dir(module)  # pylint: disable=no-member
+    def record(*args, **kwargs):
+        """Record shortcut call, with nodes replaced by module paths."""
+        declarations.append((shortcut_name,
+                             _detach_nodes(args, module_dir),
+                             _detach_nodes(kwargs, module_dir)))
+    return record
+
+def _detach_nodes(value, module_dir):
+    """Return `value` with FS nodes replaced by paths relative to module.
+
+    Nodes created while reading a module SConscript belong to the module
+     source dir, so they are stored as relative paths that can be used in
+     the variant dir of every flavor.
+    """
+    if isinstance(value, Node.FS.Base):
+        return value.get_path(module_dir)
+    if isinstance(value, dict):
+        return dict((key, _detach_nodes(val, module_dir))
+                    for key, val in value.iteritems())
+    if isinstance(value, tuple):
+        return tuple(_detach_nodes(val, module_dir) for val in value)
+    if SCons.Util.is_List(value):
+        return [_detach_nodes(val, module_dir) for val in value]
+    return value
+
+# Construction variables that control unity builds (can be overridden
+#  per library, as `Lib` keyword arguments)
+_UNITY_VARS = ('UNITY_BUILD', 'UNITY_MAX_SOURCES', 'UNITY_EXCLUDE')
+
+# Suffixes of C++ sources that are batched in unity builds
+_UNITY_SUFFIXES = frozenset(['.cc', '.cpp', '.cxx', '.c++'])
+
+def _write_unity_source(target, source, env):  # pylint: disable=unused-argument
+    """Write unity source that includes the sources listed in source Value."""
+    with open(target[0].get_abspath(), 'w') as unity_file:
+        unity_file.write('// Unity source - generated by SCons\n')
+        for include in source[0].read():
+            unity_file.write('#include "%s"\n' % (include))
+
+_UNITY_SOURCE_ACTION = SCons.Action.Action(
+    _write_unity_source, 'Generating unity source $TARGET')
+
+class _ProtocBatchTargets(list):
+    """Target nodes of a batched Protoc call.
+
+    The targets of a Protoc batch are created when the pending batches are
+     flushed, so the list flushes them when it is read before that.
+    """
+
+    def __init__(self, flush):
+        super(_ProtocBatchTargets, self).__init__()
+        self.flush = flush
+
+    def _resolve(self):
+        """Flush the pending Protoc batches, if not flushed yet."""
+        if self.flush:
+            self.flush()
+
+    def __iter__(self):
+        self._resolve()
+        return super(_ProtocBatchTargets, self).__iter__()
+
+    def __len__(self):
+        self._resolve()
+        return super(_ProtocBatchTargets, self).__len__()
+
+    def __getitem__(self, index):
+        self._resolve()
+        return super(_ProtocBatchTargets, self).__getitem__(index)
+
+    def __getslice__(self, start, stop):
+        self._resolve()
+        return super(_ProtocBatchTargets, self).__getslice__(start, stop)
+
+    def __contains__(self, item):
+        self._resolve()
+        return super(_ProtocBatchTargets, self).__contains__(item)
+
+    def __add__(self, other):
+        return list(self) + other
+
+    def __radd__(self, other):
+        return other + list(self)
+
+    def __repr__(self):
+        self._resolve()
+        return super(_ProtocBatchTargets, self).__repr__()
+
 class FlavorBuilder(object):
     """Build manager class for flavor."""
 
@@ -65,50 +548,50 @@ class FlavorBuilder(object):
         self._flavor = flavor
         # Create construction env clone for flavor customizations
         self._env = base_env.Clone()
-        # Initialize shared libraries dictionary
-        self._libs = dict()
+        # Initialize shared libraries registry
+        self._libs = LibraryRegistry(self._key_sep)
         # Initialize programs dictionary
         self._progs = defaultdict(list)
+        # Initialize pending Protoc batches of current module
+        self._protoc_batches = OrderedDict()
+        # Shared codegen manager (None if code is generated per flavor)
+        self._codegen = base_env.codegen
+        # Initialize flavor path -> shared generated node dictionary
+        self._generated = dict()
+        # Initialize shared generated node -> flavor path dictionary
+        self._flavor_nodes = dict()
+        # Initialize module -> precompiled header node dictionary
+        self._pchs = dict()
         # Apply flavored env overrides and customizations
         if flavor in ENV_OVERRIDES:
             self._env.Replace(**ENV_OVERRIDES[flavor])
         if flavor in ENV_EXTENSIONS:
             self._env.Append(**ENV_EXTENSIONS[flavor])
+        # Apply the flavor link strategy (if any)
+        link_strategy = self._env.get('LINK_STRATEGY')
+        if link_strategy:
+            if link_strategy not in LINK_STRATEGIES:
+                raise StopError('Unknown link strategy "%s" for flavor %s.' %
+                                (link_strategy, flavor))
+            self._env.Replace(**LINK_STRATEGIES[link_strategy])
+            self._env.Tool('linkstrategy')
         # Support using the flavor name as target name for its related targets
         self._env.Alias(flavor, '$BUILDROOT')
 
     def build(self):
-        """Build flavor using two-pass strategy."""
-        # First pass over all modules - process and collect library targets
-        for module in modules():
-            # Verify the SConscript file exists
-            sconscript_path = os.path.join(module, 'SConscript')
-            if not os.path.isfile(sconscript_path):
-                raise StopError('Missing SConscript file for module %s.' %
-                                (module))
-            sprint('|- First pass: Reading module %s ...', module)
-            shortcuts = dict(
-                Lib       = self._lib_wrapper(self._env.Library, module),
-                StaticLib = self._lib_wrapper(self._env.StaticLibrary, module),
-                SharedLib = self._lib_wrapper(self._env.SharedLibrary, module),
-                Protoc    = self._env.Protoc,
-                Prog      = nop,
-            )
-            SCons.Script._SConscript.GlobalDict.update(shortcuts)  # pylint: disable=protected-access
-            self._env.SConscript(
-                sconscript_path,
-                variant_dir=os.path.join('$BUILDROOT', module))
-        # Second pass over all modules - process program targets
-        shortcuts = dict()
-        for nop_shortcut in ('Lib', 'StaticLib', 'SharedLib', 'Protoc'):
-            shortcuts[nop_shortcut] = nop
-        for module in modules():
-            sprint('|- Second pass: Reading module %s ...', module)
-            shortcuts['Prog'] = self._prog_wrapper(module)
-            SCons.Script._SConscript.GlobalDict.update(shortcuts)  # pylint: disable=protected-access
-            self._env.SConscript(
-                os.path.join(module, 'SConscript'),
-                variant_dir=os.path.join('$BUILDROOT', module))
+        """Build flavor using the configured SConscript reading strategy."""
+        start_time = time.time()
+        if 'declarative' == SCONSCRIPT_READ_MODE:
+            self._instantiate_declarations()
+        elif 'single-pass' == SCONSCRIPT_READ_MODE:
+            self._read_single_pass()
+        elif 'two-pass' == SCONSCRIPT_READ_MODE:
+            self._read_two_pass()
+        else:
+            raise StopError('Unknown SConscript read mode "%s".' %
+                            (SCONSCRIPT_READ_MODE))
+        sprint('|- Processed modules (%s) in %.3f sec',
+               SCONSCRIPT_READ_MODE, time.time() - start_time)
         # Add install targets for programs from all modules
         for module, prog_nodes in self._progs.iteritems():
             for prog in prog_nodes:
@@ -119,24 +602,249 @@ class FlavorBuilder(object):
         # Support using the flavor name as target name for its related targets
         self._env.Alias(self._flavor, '$BUILDROOT')
 
-    def _lib_wrapper(self, bldr_func, module):
+    def _instantiate_declarations(self):
+        """Create flavor targets from flavor-independent module declarations.
+
+        Modules are read once per run (see `module_declarations`), and each
+         declaration is instantiated in the module variant dir of the flavor,
+         just like it would have been by reading the SConscript there.
+        Protoc declarations of a module are processed first (so they can
+         be batched), followed by Pch declarations (so every compile in the
+         module can use the PCH), and program declarations are processed
+         after all library declarations.
+        """
+        deferred_progs = list()
+        for module, declarations in module_declarations(self._env):
+            variant_dir = self._env.Dir(os.path.join('$BUILDROOT', module))
+            self._env.VariantDir(variant_dir, module)
+            shortcuts = self._lib_shortcuts(module)
+            for shortcut_name, args, kwargs in sorted(
+                    declarations, key=lambda decl: _DECLARATION_ORDER.get(
+                        decl[0], len(_DECLARATION_ORDER))):
+                if 'Prog' == shortcut_name:
+                    deferred_progs.append((module, variant_dir, args, kwargs))
+                else:
+                    call_in_dir(self._env, variant_dir,
+                                shortcuts[shortcut_name], args, kwargs)
+            self._flush_protoc_batches()
+        for module, prog_dir, args, kwargs in deferred_progs:
+            call_in_dir(self._env, prog_dir, self._prog_wrapper(module),
+                        args, kwargs)
+
+    def _read_two_pass(self):
+        """Read all modules twice - first libraries, then programs."""
+        # First pass over all modules - process and collect library targets
+        for module in discover_modules():
+            sprint('|- First pass: Reading module %s ...', module)
+            shortcuts = self._lib_shortcuts(module)
+            shortcuts['Prog'] = nop
+            self._read_module(module, shortcuts, 'first pass')
+        # Second pass over all modules - process program targets
+        shortcuts = dict()
+        for nop_shortcut in ('Lib', 'StaticLib', 'SharedLib', 'Protoc',
+                             'Pch'):
+            shortcuts[nop_shortcut] = nop
+        for module in discover_modules():
+            sprint('|- Second pass: Reading module %s ...', module)
+            shortcuts['Prog'] = self._prog_wrapper(module)
+            self._read_module(module, shortcuts, 'second pass')
+
+    def _read_single_pass(self):
+        """Read all modules once, deferring program targets.
+
+        Library and Protoc targets are processed as modules are read.
+        `Prog` calls are recorded (with the directory they were made in),
+         and processed after all modules were read, so every library is
+         known when resolving `with_libs`.
+        """
+        deferred_progs = list()
+        for module in discover_modules():
+            sprint('|- Reading module %s ...', module)
+            shortcuts = self._lib_shortcuts(module)
+            shortcuts['Prog'] = self._deferred_prog_wrapper(module,
+                                                            deferred_progs)
+            self._read_module(module, shortcuts, 'single pass')
+        # Process recorded programs - from the directory they were made in
+        for module, prog_dir, args, kwargs in deferred_progs:
+            call_in_dir(self._env, prog_dir, self._prog_wrapper(module),
+                        args, kwargs)
+
+    def _lib_shortcuts(self, module):
+        """Return dictionary of library & Protoc shortcuts for module."""
+        return dict(
+            Lib       = self._lib_wrapper(self._env.Library, module),
+            StaticLib = self._lib_wrapper(self._env.StaticLibrary, module),
+            SharedLib = self._lib_wrapper(self._env.SharedLibrary, module,
+                                          shared=True),
+            Protoc    = self._protoc_wrapper(module),
+            Pch       = self._pch_wrapper(module),
+        )
+
+    def _read_module(self, module, shortcuts, phase):
+        """Read the SConscript of module in the flavor variant dir."""
+        read_sconscript(self._env, module, shortcuts,
+                        variant_dir=os.path.join('$BUILDROOT', module),
+                        phase='%s %s' % (self._flavor, phase))
+        self._flush_protoc_batches()
+
+    def _protoc_wrapper(self, module):
+        """Return a Protoc shortcut for module that batches calls.
+
+        When $PROTOCBATCH is set, Protoc calls (with no explicit targets)
+         that share the same settings are merged into a single Protoc
+         target per module, running protoc once for all their sources.
+        The batched targets are created by `_flush_protoc_batches` (before
+         the next library / program / PCH of the module, and at its end),
+         and a batched call returns the targets of its batch (flushing the
+         pending batches when they are read before that).
+        """
+        def build_protoc(target=None, source=None, *args, **kwargs):
+            """Customized Protoc builder.
+
+            @param  target      Explicit targets (disables batching)
+            @param  source      Proto file (or list of proto files)
+            """
+            if source is None:
+                # Called with sources only (like SCons builders support)
+                target, source = None, target
+            if target or args:
+                return self._env.Protoc(target, source, *args, **kwargs)
+            cur_dir = self._env.fs.getcwd()
+            if not self._env.get('PROTOCBATCH'):
+                return self._protoc_targets(module, cur_dir, listify(source),
+                                            kwargs)
+            batch_key = (cur_dir, repr(sorted(kwargs.iteritems())))
+            if batch_key not in self._protoc_batches:
+                self._protoc_batches[batch_key] = (
+                    module, cur_dir, list(), kwargs,
+                    _ProtocBatchTargets(self._flush_protoc_batches))
+            self._protoc_batches[batch_key][2].extend(listify(source))
+            return self._protoc_batches[batch_key][4]
+        return build_protoc
+
+    def _flush_protoc_batches(self):
+        """Create Protoc targets for pending batches of current module."""
+        for module, batch_dir, sources, kwargs, targets in \
+                self._protoc_batches.itervalues():
+            targets.flush = None
+            targets.extend(self._protoc_targets(module, batch_dir, sources,
+                                                kwargs))
+        self._protoc_batches.clear()
+
+    def _protoc_targets(self, module, call_dir, sources, kwargs):
+        """Create Protoc targets for sources, return the target nodes.
+
+        With shared codegen, the targets are created under $GENROOT (once
+         for all flavors), and recorded so flavor sources that refer to
+         generated files use the shared generated nodes.
+
+        @param  module      Module name
+        @param  call_dir    Directory of the Protoc call
+        @param  sources     List of proto files
+        @param  kwargs      Keyword arguments of the Protoc call
+        """
+        if not self._codegen:
+            return call_in_dir(self._env, call_dir, self._env.Protoc,
+                               ([], sources), kwargs)
+        build_root = self._env.Dir('#$BUILDROOT')
+        gen_nodes = self._codegen.protoc(
+            module, call_dir.get_path(build_root),
+            _detach_nodes(sources, call_dir), kwargs)
+        for gen_node in gen_nodes:
+            flavor_node = build_root.File(gen_node.get_path(self._codegen.root))
+            self._generated[flavor_node] = gen_node
+            self._flavor_nodes[gen_node] = flavor_node
+        return gen_nodes
+
+    def _pch_wrapper(self, module):
+        """Return a precompiled header shortcut for module.
+
+        The PCH is built in the module variant dir of the flavor, and
+         library and program targets of the module that follow it are
+         compiled with it.
+        A header that refers to a shared generated file (under $GENROOT) is
+         precompiled from the shared generated node (like in `_objects`),
+         after creating pending Protoc targets of the module.
+        """
+        def build_pch(header, *args, **kwargs):
+            """Customized precompiled header builder.
+
+            @param  header      Header file to precompile
+            """
+            if module in self._pchs:
+                raise StopError('Module %s has more than one Pch.' % (module))
+            self._flush_protoc_batches()
+            header_node = None if args else self._env.File(header)
+            header_node = self._flavor_nodes.get(header_node, header_node)
+            if header_node in self._generated:
+                pch_name = (os.path.splitext(header_node.name)[0] +
+                            self._env.subst('$PCHSUFFIX'))
+                pchs = self._env.Pch(header_node.dir.File(pch_name),
+                                     self._generated[header_node], **kwargs)
+            else:
+                pchs = self._env.Pch(header, *args, **kwargs)
+            self._pchs[module] = pchs[0]
+        return build_pch
+
+    def _depend_on_pch(self, module, target_nodes):
+        """Make objects of target nodes depend on the module PCH (if any)."""
+        if module not in self._pchs:
+            return
+        obj_suffixes = (self._env.subst('$OBJSUFFIX'),
+                        self._env.subst('$SHOBJSUFFIX'))
+        for target_node in target_nodes:
+            for src_node in target_node.sources:
+                if (src_node.has_builder() and
+                        src_node.get_suffix() in obj_suffixes):
+                    self._env.Depends(src_node, self._pchs[module])
+
+    def _deferred_prog_wrapper(self, module, deferred_progs):
+        """Return a program shortcut for module that records its calls.
+
+        @param  module              Module name
+        @param  deferred_progs      List to append recorded calls to
+        """
+        def defer_prog(*args, **kwargs):
+            """Record program builder call for later processing."""
+            deferred_progs.append((module, self._env.fs.getcwd(),
+                                   args, kwargs))
+        return defer_prog
+
+    def _lib_wrapper(self, bldr_func, module, shared=False):
         """Return a wrapped customized flavored library builder for module.
 
         @param  builder_func        Underlying SCons builder function
         @param  module              Module name
+        @param  shared              Whether the library is a shared library
         """
-        def build_lib(lib_name, sources, *args, **kwargs):
+        def build_lib(lib_name, sources, with_libs=None, *args, **kwargs):
             """Customized library builder.
 
             @param  lib_name    Library name
             @param  sources     Source file (or list of source files)
+            @param  with_libs   Library name (or list of library names) this
+                                library depends on. Programs that link with
+                                this library will link with them too.
             """
             # Create unique library key from module and library name
             lib_key = self.lib_key(module, lib_name)
-            assert lib_key not in self._libs
-            # Store resulting library node in shared dictionary
-            self._libs[lib_key] = bldr_func(lib_name, sources,
-                                            *args, **kwargs)
+            # Make sure preceding Protoc calls have their targets
+            self._flush_protoc_batches()
+            # Compile batched unity sources instead of C++ sources (if enabled)
+            unity = dict((var, kwargs.pop(var, self._env.get(var)))
+                         for var in _UNITY_VARS)
+            if unity['UNITY_BUILD']:
+                sources = self._unity_sources(
+                    lib_name, sources, unity['UNITY_MAX_SOURCES'] or 8,
+                    unity['UNITY_EXCLUDE'])
+            # Compile with the module precompiled header (if any)
+            if module in self._pchs:
+                kwargs.setdefault('PCH', self._pchs[module])
+            # Store resulting library node in shared registry
+            sources = self._objects(sources, shared, kwargs)
+            lib_nodes = bldr_func(lib_name, sources, *args, **kwargs)
+            self._depend_on_pch(module, lib_nodes)
+            self._libs.add(lib_key, lib_nodes, with_libs)
         return build_lib
 
     def _prog_wrapper(self, module, default_install=True):
@@ -156,29 +864,25 @@ class FlavorBuilder(object):
             @param  install     Binary flag to override default value from
                                 closure (`default_install`).
             """
-            # Make sure sources is a list
-            sources = listify(sources)
+            # Make sure preceding Protoc calls have their targets
+            self._flush_protoc_batches()
             install_flag = kwargs.pop('install', default_install)
+            # Compile with the module precompiled header (if any)
+            if module in self._pchs:
+                kwargs.setdefault('PCH', self._pchs[module])
+            # Make sure sources is a list
+            sources = self._objects(sources, overrides=kwargs)
             # Process library dependencies - add libs specified in `with_libs`
-            for lib_name in listify(with_libs):
-                lib_keys = listify(self._get_matching_lib_keys(lib_name))
-                if len(lib_keys) == 1:
-                    # Matched internal library
-                    lib_key = lib_keys[0]
-                    # Extend prog sources with library nodes
-                    sources.extend(self._libs[lib_key])
-                elif len(lib_keys) > 1:
-                    # Matched multiple internal libraries - probably bad!
-                    raise StopError('Library identifier "%s" matched %d '
-                                    'libraries (%s). Please use a fully '
-                                    'qualified identifier instead!' %
-                                    (lib_name, len(lib_keys),
-                                     ', '.join(lib_keys)))
-                else:  # empty lib_keys
-                    raise StopError('Library identifier "%s" didn\'t match '
-                                    'any library. Is it a typo?' % (lib_name))
+            #  along with their dependencies, in link order
+            with profiler.span('libs of %s' % (self.lib_key(module, prog_name)),
+                               'libs', flavor=self._flavor):
+                lib_keys = self._libs.link_order(with_libs)
+            for lib_key in lib_keys:
+                # Extend prog sources with library nodes
+                sources.extend(self._libs[lib_key])
             # Build the program and add to prog nodes dict if installable
             prog_nodes = self._env.Program(prog_name, sources, *args, **kwargs)
+            self._depend_on_pch(module, prog_nodes)
             if install_flag:
                 # storing each installable node in a dictionary instead of
                 #  defining InstallAs target on the spot, because there's
@@ -186,20 +890,86 @@ class FlavorBuilder(object):
                 self._progs[module].extend(prog_nodes)
         return build_prog
 
-    def _get_matching_lib_keys(self, lib_query):
-        """Return list of library keys for given library name query.
+    def _unity_sources(self, lib_name, sources, max_sources,
+                       exclude_patterns=None):
+        """Return list of sources, with C++ sources batched in unity sources.
+
+        Every unity source (`<lib_name>_unity_<N>.cc`) includes up to
+         `max_sources` C++ sources (including shared generated sources),
+         so they are compiled as a single translation unit.
+        Sources that match an exclude pattern are compiled on their own.
+        The unity sources depend only on the list of included sources, and
+         the included sources are found by the C++ scanner, so editing
+         a source rebuilds only the object of its batch.
+        Other sources are returned as is.
 
-        A "library query" is either a fully-qualified "Module::LibName" string
-         or just a "LibName".
-        If just "LibName" form, return all matches from all modules.
+        @param  lib_name        Library name
+        @param  sources         Source file (or list of source files)
+        @param  max_sources     Maximum number of sources per unity source
+        @param  exclude_patterns    File name pattern (or list of patterns)
+                                    of sources to compile on their own
         """
-        if self.is_lib_key(lib_query):
-            # It's a fully-qualified "Module::LibName" query
-            if lib_query in self._libs:
-                # Got it. We're done.
-                return [lib_query]
-        else:
-            # It's a target-name-only query. Search for matching lib keys.
-            lib_key_suffix = '%s%s' % (self._key_sep, lib_query)
-            return [lib_key for lib_key in self._libs
-                    if lib_key.endswith(lib_key_suffix)]
+        cur_dir = self._env.fs.getcwd()
+        exclude_patterns = listify(exclude_patterns)
+        result = list()
+        batch_nodes = list()
+        for src in listify(sources):
+            src_node = self._env.File(src) if isinstance(src, basestring) \
+                else src
+            if (isinstance(src_node, Node.FS.File) and
+                    src_node.suffix in _UNITY_SUFFIXES and
+                    not any(fnmatch.fnmatch(src_node.name, pattern)
+                            for pattern in exclude_patterns)):
+                batch_nodes.append((src, src_node))
+            else:
+                result.append(src)
+        max_sources = max(1, int(max_sources))
+        for batch_idx in xrange(0, len(batch_nodes), max_sources):
+            batch = batch_nodes[batch_idx:batch_idx + max_sources]
+            if len(batch) == 1:
+                # Nothing to gain from a unity source with a single source
+                result.append(batch[0][0])
+                continue
+            unity_node = cur_dir.File('%s_unity_%d.cc' % (
+                path_to_key(lib_name), batch_idx // max_sources))
+            # Include sources relative to the unity source dir
+            includes = [
+                os.path.relpath(self._generated.get(node, node).get_path(),
+                                cur_dir.get_path())
+                for _, node in batch]
+            result.extend(self._env.Command(
+                unity_node, self._env.Value(includes), _UNITY_SOURCE_ACTION))
+        return result
+
+    def _objects(self, sources, shared=False, overrides=None):
+        """Return list of sources, with generated sources replaced by objects.
+
+        Sources that refer to shared generated files (under $GENROOT), by
+         flavor path or as generated nodes (e.g. returned by Protoc), are
+         compiled explicitly into objects in the flavor variant dir, as if
+         the generated files were generated in the flavor variant dir.
+        Other sources are returned as is.
+
+        @param  sources     Source file (or list of source files)
+        @param  shared      Whether the objects are for a shared library
+        @param  overrides   Construction variable overrides for the objects
+        """
+        if not self._generated:
+            return listify(sources)
+        obj_bldr = self._env.SharedObject if shared else self._env.StaticObject
+        obj_suffix = self._env.subst('$SHOBJSUFFIX' if shared else
+                                     '$OBJSUFFIX')
+        result = list()
+        for src in listify(sources):
+            if isinstance(src, basestring):
+                src_node = self._env.File(src)
+            else:
+                src_node = self._flavor_nodes.get(src, src)
+            if src_node in self._generated:
+                obj_name = os.path.splitext(src_node.name)[0] + obj_suffix
+                result.extend(obj_bldr(src_node.dir.File(obj_name),
+                                       self._generated[src_node],
+                                       **(overrides or {})))
+            else:
+                result.append(src)
+        return result
@@ -0,0 +1,94 @@
+# Copyright 2015 The Ostrich / by Itamar O
+
+"""
+depfiles.py: Compiler-generated C/C++ dependencies for SCons
+
+C/C++ compiles write Makefile-style depfiles (`-MMD -MF $TARGET.d`), and
+the object builders source scanner reads the depfile of the object (when
+it exists) as the implicit dependencies of its sources, instead of
+scanning the sources and every included header with the Python C scanner.
+Objects without a depfile (e.g. on the first build) fall back to the
+C scanner.
+"""
+
+__author__ = "Itamar Ostricher"
+
+import os
+
+import SCons
+
+from site_utils import depfile_deps
+
+def _c_scan(node, env, c_path):
+    """Return implicit dependencies of node using its default scanner."""
+    scanner = SCons.Tool.SourceFileScanner.select(node)
+    return scanner(node, env, c_path) if scanner else []
+
+class _DepfilePath(tuple):
+    """Scanner path of an object with a depfile.
+
+    A (depfile path, source nodes, C scanner path) tuple.
+    """
+    pass
+
+def depfile_path(env, cwd, target, source):
+    """Return scanner path for the depfile scanner.
+
+    If the target has a depfile, return a _DepfilePath.
+    Otherwise, return the C scanner path (so results for included headers
+     are shared by all objects, like they are with the C scanner).
+    """
+    c_path = SCons.Tool.CScanner.path(env, cwd, target, source)
+    if target:
+        depfile = target[0].get_abspath() + env.subst('$DEPFILESUFFIX')
+        if os.path.isfile(depfile):
+            return _DepfilePath((depfile, tuple(source), c_path))
+    return c_path
+
+def depfile_scan(node, env, path):
+    """Return implicit dependencies of node, from depfile if possible.
+
+    With a depfile, the dependencies of the sources are the depfile
+     dependencies (that exist, or can be built), and the included headers
+     have no dependencies of their own (the depfile lists all of them).
+    Otherwise, the C scanner is used.
+    """
+    if not isinstance(path, _DepfilePath):
+        return _c_scan(node, env, path)
+    depfile, sources, c_path = path
+    if node not in sources:
+        return []
+    try:
+        with open(depfile) as depfile_file:
+            dep_paths = depfile_deps(depfile_file.read())
+    except IOError:
+        return _c_scan(node, env, c_path)
+    deps = list()
+    for dep_path in dep_paths:
+        dep_node = env.fs.File(dep_path, env.fs.Top)
+        if dep_node in sources:
+            continue
+        if dep_node.has_builder() or dep_node.exists():
+            deps.append(dep_node)
+    return deps
+
+DepfileScanner = SCons.Scanner.Base(  # pylint: disable=invalid-name
+    function=depfile_scan, name='DepfileScanner', path_function=depfile_path,
+    recursive=True)
+
+def generate(env):
+    """Add depfile flags and scanner to the C/C++ object builders
+    of the build Environment."""
+    # pylint: disable=bad-whitespace
+    env['DEPFILESUFFIX']  = '.d'
+    # Depfile flags are excluded from build signatures
+    env['_DEPFILEFLAGS']  = '$( -MMD -MF ${TARGET}$DEPFILESUFFIX $)'
+    env.AppendUnique(CCFLAGS=['$_DEPFILEFLAGS'])
+    for bldr_name in ('StaticObject', 'SharedObject'):
+        if bldr_name in env['BUILDERS']:
+            env['BUILDERS'][bldr_name].source_scanner = DepfileScanner
+
+def exists(env):
+    """Return True if a C/C++ compiler exists in the system."""
+    return env.Detect(env.get('CXX', 'clang++')) or env.Detect(
+        env.get('CC', 'clang'))
@@ -0,0 +1,84 @@
+# Copyright 2015 The Ostrich / by Itamar O
+
+"""
+installmode.py: Zero-copy file installation modes for SCons
+
+Replaces the install function ($INSTALL) of Install / InstallAs with one
+that installs files according to $INSTALL_MODE:
+  - 'hardlink': hard link to the source file
+  - 'reflink': copy-on-write clone of the source file (FICLONE), where the
+    filesystem supports it (e.g. btrfs, xfs)
+  - 'symlink': relative symbolic link to the source file
+  - 'copy': copy the source file (the SCons default)
+Installation falls back to copying when the mode isn't supported for the
+files (e.g. hard links or reflinks across devices).
+Up-to-date checks are unaffected: SCons removes targets before rebuilding
+them, so a relinked program is a new file, and its install target is
+rebuilt (linking to the new file) because its source changed.
+"""
+
+__author__ = "Itamar Ostricher"
+
+import errno
+import os
+import shutil
+
+from SCons.Errors import StopError
+from SCons.Tool.install import copyFunc
+
+_INSTALL_MODES = ('hardlink', 'reflink', 'symlink', 'copy')
+
+# Linux FICLONE ioctl request (_IOW(0x94, 9, int))
+_FICLONE = 0x40049409
+
+# Errors that mean the mode isn't supported for the files (so copy instead)
+_FALLBACK_ERRNOS = frozenset([
+    errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP, errno.ENOTTY,
+    errno.EINVAL, errno.ENOSYS, errno.EBADF])
+
+def _reflink(dest, source):
+    """Create dest as a copy-on-write clone of source."""
+    import fcntl
+    with open(source, 'rb') as src_file:
+        with open(dest, 'wb') as dest_file:
+            fcntl.ioctl(dest_file.fileno(), _FICLONE, src_file.fileno())
+    shutil.copystat(source, dest)
+
+def _symlink(dest, source):
+    """Create dest as a relative symbolic link to source."""
+    os.symlink(os.path.relpath(source, os.path.dirname(dest) or os.curdir),
+               dest)
+
+def install_func(dest, source, env):
+    """Install source file as dest by $INSTALL_MODE (copy as fallback)."""
+    mode = env.subst('$INSTALL_MODE') or 'copy'
+    if mode not in _INSTALL_MODES:
+        raise StopError('Unknown install mode "%s" (expected one of %s).' %
+                        (mode, ', '.join(_INSTALL_MODES)))
+    if 'copy' == mode or os.path.isdir(source):
+        return copyFunc(dest, source, env)
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        if 'hardlink' == mode:
+            os.link(source, dest)
+        elif 'reflink' == mode:
+            _reflink(dest, source)
+        else:
+            _symlink(dest, source)
+    except (IOError, OSError) as exc:
+        if exc.errno not in _FALLBACK_ERRNOS:
+            raise
+        if os.path.lexists(dest):
+            os.remove(dest)
+        return copyFunc(dest, source, env)
+    return 0
+
+def generate(env):
+    """Install files in the build Environment by $INSTALL_MODE."""
+    env.SetDefault(INSTALL_MODE='copy')
+    env['INSTALL'] = install_func
+
+def exists(env):  # pylint: disable=unused-argument
+    """Return True (installation modes are always available)."""
+    return True
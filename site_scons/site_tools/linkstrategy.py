@@ -0,0 +1,109 @@
+# Copyright 2015 The Ostrich / by Itamar O
+
+"""
+linkstrategy.py: Fast-link strategy settings for SCons
+
+Applies the link strategy settings of a build Environment:
+  - THIN_ARCHIVES: static libraries are thin archives (`ar rcT`), that
+    reference their objects instead of copying them. Programs depend on
+    the objects of the thin archives they link with, because the archive
+    content doesn't change when its objects do.
+  - SPLIT_DWARF: objects are compiled with `-gsplit-dwarf`, so debug info
+    goes to `.dwo` files (additional targets of the objects, that are
+    removed from library and program sources) and isn't linked.
+  - LINKERS: preferred linkers (e.g. ['lld', 'gold']) - the first one
+    found (`ld.<name>`) is used with `-fuse-ld=<name>`, falling back to the
+    default linker if none is found.
+  - GDB_INDEX: link with `-Wl,--gdb-index` (only with lld / gold).
+"""
+
+__author__ = "Itamar Ostricher"
+
+import os
+
+import SCons
+
+from site_utils import listify, sprint
+
+def thin_archive_emitter(target, source, env):
+    """Record objects of thin archives on the archive nodes."""
+    if env.get('THIN_ARCHIVES'):
+        for tgt in target:
+            tgt.attributes.thin_archive_members = list(source)
+    return target, source
+
+def thin_archive_prog_emitter(target, source, env):
+    """Make programs depend on the objects of thin archives they link."""
+    for src in source:
+        members = getattr(src.attributes, 'thin_archive_members', None)
+        if members:
+            env.Depends(target, members)
+    return target, source
+
+def split_dwarf_emitter(target, source, env):
+    """Add the `.dwo` files of objects compiled with split DWARF as side
+    targets."""
+    if env.get('SPLIT_DWARF'):
+        target = target + [
+            tgt.dir.File(os.path.splitext(tgt.name)[0] + '.dwo')
+            for tgt in target]
+    return target, source
+
+def split_dwarf_link_emitter(target, source, env):
+    """Remove `.dwo` files of objects from sources of libraries and
+    programs (debug info in `.dwo` files isn't linked)."""
+    if env.get('SPLIT_DWARF'):
+        source = [src for src in source if not str(src).endswith('.dwo')]
+    return target, source
+
+def _add_object_emitters(env):
+    """Add the split DWARF emitter to the C/C++ object builders (once).
+
+    The object builders are shared by all cloned environments, so the
+     emitter does nothing in environments without SPLIT_DWARF.
+    """
+    for bldr_name in ('StaticObject', 'SharedObject'):
+        bldr = env['BUILDERS'].get(bldr_name)
+        if bldr is None:
+            continue
+        for suffix, emitter in bldr.emitter.items():
+            if (isinstance(emitter, SCons.Builder.ListEmitter) and
+                    split_dwarf_emitter in emitter):
+                continue
+            bldr.emitter[suffix] = SCons.Builder.ListEmitter(
+                [emitter, split_dwarf_emitter])
+
+def find_linker(env, linkers):
+    """Return name of the first linker in `linkers` found (None if none)."""
+    for linker in listify(linkers):
+        if env.WhereIs('ld.%s' % (linker)):
+            return linker
+    return None
+
+def generate(env):
+    """Apply the link strategy settings of the build Environment."""
+    # pylint: disable=bad-whitespace
+    env.SetDefault(THIN_ARCHIVES=False, SPLIT_DWARF=False, LINKERS=[],
+                   GDB_INDEX=False)
+    if env['THIN_ARCHIVES']:
+        env['ARFLAGS']    = SCons.Util.CLVar('rcT')
+        env.Append(LIBEMITTER=[thin_archive_emitter],
+                   PROGEMITTER=[thin_archive_prog_emitter])
+    if env['SPLIT_DWARF']:
+        env.Append(CCFLAGS=['-gsplit-dwarf'])
+        _add_object_emitters(env)
+        env.Prepend(LIBEMITTER=[split_dwarf_link_emitter],
+                    SHLIBEMITTER=[split_dwarf_link_emitter],
+                    PROGEMITTER=[split_dwarf_link_emitter])
+    linker = find_linker(env, env['LINKERS'])
+    if linker:
+        env.Append(LINKFLAGS=['-fuse-ld=%s' % (linker)])
+        if env['GDB_INDEX']:
+            env.Append(LINKFLAGS=['-Wl,--gdb-index'])
+    elif env['LINKERS']:
+        sprint('None of the linkers %s found, using the default linker',
+               ', '.join(listify(env['LINKERS'])))
+
+def exists(env):
+    """Return True if an archiver exists in the system."""
+    return env.Detect(env.get('AR', 'ar'))
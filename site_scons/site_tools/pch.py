@@ -0,0 +1,91 @@
+# Copyright 2015 The Ostrich / by Itamar O
+
+"""
+pch.py: Precompiled header Builder for SCons
+
+The Pch Builder compiles a C++ header into a precompiled header.
+Its source scanner is the C scanner, so the PCH is rebuilt when any of the
+header transitive includes changes.
+C++ compiles with a non-empty $PCH construction variable use that PCH
+(by adding $PCHUSEFLAGS to their flags).
+The PCH format depends on the C++ compiler ($CXX), detected by its
+`--version` output when the PCH is used:
+  - clang: `.pch` files, used with `-include-pch`
+  - gcc: `.h.gch` files, used with `-include` of the header path (gcc
+    uses the `.gch` file next to it)
+  - other compilers: compiles don't use the PCH
+"""
+
+__author__ = "Itamar Ostricher"
+
+import shlex
+import subprocess
+
+import SCons
+
+# Cached C++ compiler families (by compiler command)
+_COMPILER_FAMILIES = dict()
+
+def compiler_family(env):
+    """Return family of the C++ compiler of env ('clang', 'gcc', or None
+    if unknown)."""
+    cxx = env.subst('$CXX')
+    if cxx not in _COMPILER_FAMILIES:
+        family = None
+        cmd = shlex.split(cxx)
+        try:
+            proc = subprocess.Popen(
+                [env.WhereIs(cmd[0]) or cmd[0]] + cmd[1:] + ['--version'],
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            version = proc.communicate()[0].lower()
+        except (OSError, IndexError):
+            version = ''
+        if 'clang' in version:
+            family = 'clang'
+        elif 'gcc' in version or 'free software foundation' in version:
+            family = 'gcc'
+        _COMPILER_FAMILIES[cxx] = family
+    return _COMPILER_FAMILIES[cxx]
+
+def pch_suffix(env):
+    """Return precompiled header suffix for the C++ compiler of env."""
+    return '.h.gch' if 'gcc' == compiler_family(env) else '.pch'
+
+def pch_use_flags(env):
+    """Return flags for compiling with $PCH, for the C++ compiler of env."""
+    family = compiler_family(env)
+    if 'clang' == family:
+        return ['-include-pch', '$PCH']
+    if 'gcc' == family:
+        return ['-include', '${str(PCH)[:-len(".gch")]}']
+    return []
+
+def generate(env):
+    """Add Builders and construction variables for precompiled headers
+    to the build Environment."""
+    try:
+        bldr = env['BUILDERS']['Pch']
+    except KeyError:
+        action = SCons.Action.Action('$PCHCOM', '$PCHCOMSTR')
+        bldr = SCons.Builder.Builder(action=action,
+                                     suffix='$PCHSUFFIX',
+                                     source_scanner=SCons.Tool.CScanner)
+        env['BUILDERS']['Pch'] = bldr
+
+    # pylint: disable=bad-whitespace
+    # PCH suffix and flags by the C++ compiler (detected when used)
+    env['_pch_suffix']    = pch_suffix
+    env['_pch_use_flags'] = pch_use_flags
+    env['PCHSUFFIX']   = '${_pch_suffix(__env__)}'
+    env['PCHCOM']      = ('$CXX -x c++-header -o $TARGET -c $CXXFLAGS '
+                          '$CCFLAGS $_CCCOMCOM $SOURCE')
+    # Precompiled header to compile C++ sources with (none by default)
+    env['PCH']         = ''
+    # Flags for compiling with the precompiled header $PCH
+    env['PCHUSEFLAGS'] = '${_pch_use_flags(__env__)}'
+    env['_PCHFLAGS']   = '${PCH and PCHUSEFLAGS or ""}'
+    env.AppendUnique(CXXFLAGS=['$_PCHFLAGS'])
+
+def exists(env):
+    """Return True if a C++ compiler exists in the system."""
+    return env.Detect(env.get('CXX', 'clang++'))
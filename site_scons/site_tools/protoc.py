@@ -33,30 +33,99 @@ Derived from original work by Scott Stafford
 
 __author__ = "Itamar Ostricher"
 
+import atexit
 import os
-import re
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 import SCons
 
+from site_utils import proto_imports
+
 _PROTOCS = 'protoc'
 _PROTOSUFFIX = '.proto'
 
-_PROTOC_SCANNER_RE = re.compile(r'^import\s+\"(.+\.proto)\"\;$', re.M)
+class _ProtoImportsCache(object):
+    """Persistent cache of proto imports, keyed by proto content signature.
+
+    The cache is shared by all flavors (proto files in different variant
+     dirs with the same content have the same signature), and saved at exit
+     for following runs, with only the entries looked up in this run (so
+     entries of edited or removed protos don't accumulate).
+    """
+
+    def __init__(self):
+        self._path = None
+        # Proto signature -> imports (loaded from the cache file)
+        self._imports = dict()
+        # Proto signature -> imports (looked up in this run)
+        self._used = dict()
+
+    def get_imports(self, node, env):
+        """Return list of imports of proto `node` (from cache if possible)."""
+        self._load(env)
+        if not node.rexists():
+            return []
+        csig = node.get_csig()
+        if csig not in self._used:
+            if csig in self._imports:
+                self._used[csig] = self._imports[csig]
+            else:
+                with open(node.rfile().get_abspath(), 'r') as proto_file:
+                    self._used[csig] = proto_imports(proto_file)
+        return self._used[csig]
+
+    def _load(self, env):
+        """Load the persistent cache file on first use."""
+        if self._path is not None:
+            return
+        self._path = env.subst('$PROTOCSCANCACHE')
+        if not self._path:
+            return
+        self._path = os.path.join(env.Dir('#').get_abspath(), self._path)
+        try:
+            with open(self._path, 'rb') as cache_file:
+                self._imports = pickle.load(cache_file)
+        except (IOError, EOFError, ValueError, TypeError,
+                pickle.UnpicklingError):
+            self._imports = dict()
+        atexit.register(self._save)
+
+    def _save(self):
+        """Atomically write the entries looked up in this run to the cache
+        file (if they differ from the loaded entries)."""
+        if set(self._used) == set(self._imports):
+            return
+        try:
+            cache_dir = os.path.dirname(self._path)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            tmp_path = '%s.%d' % (self._path, os.getpid())
+            with open(tmp_path, 'wb') as cache_file:
+                pickle.dump(self._used, cache_file,
+                            pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self._path)
+        except (IOError, OSError):
+            pass
+
+_IMPORTS_CACHE = _ProtoImportsCache()
 
 def protoc_emitter(target, source, env):
     """Return list of targets generated by Protoc builder for source."""
     for src in source:
-        proto = os.path.splitext(str(src))[0]
+        # Targets are created next to the source node (and not by its path
+        #  string), so they don't depend on the current SCons directory
         if env['PROTOCPPOUT']:
-            target.append('%s.pb.cc' % (proto))
-            target.append('%s.pb.h' % (proto))
+            target.append(src.target_from_source('', '.pb.cc'))
+            target.append(src.target_from_source('', '.pb.h'))
         if env['PROTOPYOUT']:
-            target.append('%s_pb2.py' % (proto))
+            target.append(src.target_from_source('', '_pb2.py'))
     return target, source
 
 def protoc_scanner(node, env, _):
     """Return list of file nodes that `node` imports"""
-    contents = node.get_text_contents()
     # If build location different from sources location,
     #  get the destination base dir as the base for imports.
     nodepath = str(node.path)
@@ -64,7 +133,7 @@ def protoc_scanner(node, env, _):
     src_pos = nodepath.find(srcnodepath)
     base_path = src_pos and nodepath[:src_pos-1] or ''
     imports = [os.path.join(base_path, imp)
-               for imp in _PROTOC_SCANNER_RE.findall(contents)]
+               for imp in _IMPORTS_CACHE.get_imports(node, env)]
     return env.File(imports)
 
 def generate(env):
@@ -89,6 +158,10 @@ def generate(env):
     env['PROTOCPPOUT']     = '.'
     # No default Python output
     env['PROTOPYOUT']      = ''
+    # Batch Protoc calls with same settings in a module into one protoc run
+    env['PROTOCBATCH']     = True
+    # Persistent proto imports cache file (relative to top dir, '' to disable)
+    env['PROTOCSCANCACHE'] = ''
     proto_cmd     = ['$PROTOC']
     proto_cmd.append('${["--proto_path=%s"%(x) for x in PROTOPATH]}')
     proto_cmd.append('$PROTOCFLAGS')
@@ -3,13 +3,24 @@
 """General build-system utility functions."""
 
 import os
+import re
+import time
+from collections import defaultdict
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 try:
     from SCons.Script import GetOption
+    from SCons.Errors import StopError
 except ImportError:
     def GetOption(dummy):  # pylint: disable=invalid-name
         """Stub GetOption if not running in SCons context"""
         return True
+    class StopError(Exception):
+        """Stub StopError if not running in SCons context"""
+        pass
 
 def sprint(message, *args):
     """Silent-mode-aware SCons message printer."""
@@ -49,8 +60,91 @@ def intersection(*args):
         result.intersection_update(listify(args.pop(0)))
     return result
 
+# Tokens of proto files: comments, strings, words and punctuation
+_PROTO_TOKEN_RE = re.compile(r"""
+    (?P<line_comment>//) |
+    (?P<block_comment>/\*) |
+    (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*') |
+    (?P<word>[\w.]+) |
+    (?P<punct>\S)
+""", re.X)
+
+# Top-level proto definitions that end the imports section
+_PROTO_DEFINITIONS = frozenset(['message', 'service', 'enum', 'extend'])
+
+def proto_tokens(lines):
+    """Generate tokens from proto file lines (skipping comments)."""
+    in_comment = False
+    for line in lines:
+        pos = 0
+        while pos < len(line):
+            if in_comment:
+                end_pos = line.find('*/', pos)
+                if end_pos < 0:
+                    break
+                pos = end_pos + 2
+                in_comment = False
+                continue
+            match = _PROTO_TOKEN_RE.search(line, pos)
+            if not match or match.lastgroup == 'line_comment':
+                break
+            pos = match.end()
+            if match.lastgroup == 'block_comment':
+                in_comment = True
+            else:
+                yield match.group()
+
+def proto_imports(lines):
+    """Return list of files imported by proto file with given lines.
+
+    Supports every import form (`import`, `import public`, `import weak`,
+     with single or double quotes, and comments anywhere).
+    Reading stops at the first top-level message / service / enum / extend
+     definition, so imports must precede definitions (as is customary).
+    """
+    imports = list()
+    statement = list()
+    for token in proto_tokens(lines):
+        if not statement and token in _PROTO_DEFINITIONS:
+            break
+        if ';' == token:
+            if (len(statement) in (2, 3) and 'import' == statement[0] and
+                    statement[-1][0] in '"\''):
+                imports.append(statement[-1][1:-1])
+            statement = list()
+        else:
+            statement.append(token)
+    return imports
+
+# Paths in Makefile dependency rules (with backslash-escaped spaces)
+_DEPFILE_PATH_RE = re.compile(r'(?:\\.|[^\s\\])+')
+
+def depfile_deps(content):
+    """Return list of dependency paths in compiler depfile `content`.
+
+    Depfiles are Makefile rules (`target: dep1 dep2 ...`), as written by
+     `-MD` / `-MMD`, with backslash-newline continuations.
+    The dependencies of every rule are returned (in order, without
+     duplicates).
+    """
+    deps = list()
+    seen = set()
+    for line in content.replace('\\\n', ' ').splitlines():
+        target_sep = line.find(': ')
+        if target_sep < 0:
+            if not line.rstrip().endswith(':'):
+                continue
+            target_sep = len(line)
+        for path in _DEPFILE_PATH_RE.findall(line[target_sep + 1:]):
+            path = re.sub(r'\\(.)', r'\1', path).replace('$$', '$')
+            if path not in seen:
+                seen.add(path)
+                deps.append(path)
+    return deps
+
 def module_dirs_generator(max_depth=None, followlinks=False,
-                          dir_skip_list=None, file_skip_list=None):
+                          dir_skip_list=None, file_skip_list=None,
+                          index_path=None, index_key=None):
     """Use os.walk to generate directories that contain a SConscript file.
 
     @param max_depth        Maximal depth for os.walk recursion
@@ -61,7 +155,17 @@ def module_dirs_generator(max_depth=None, followlinks=False,
                             return True if the directory should be skipped.
     @param file_skip_list   List of filenames used as dir-skip markers.
                             Directory with marker filename is a "skip dir".
+    @param index_path       Path of a persistent module index file to use
+                            instead of walking the entire tree (None to walk).
+    @param index_key        Extra value that invalidates the persistent index
+                            when changed (e.g. the config file mtime).
     """
+    if index_path:
+        index = ModuleDirsIndex(index_path, max_depth, followlinks,
+                                dir_skip_list, file_skip_list, index_key)
+        for module_dir in index.module_dirs():
+            yield module_dir
+        return
     def should_process(dirpath, filenames):
         """Return True if current directory should be processed.
 
@@ -106,3 +210,404 @@ def module_dirs_generator(max_depth=None, followlinks=False,
         # Yield directory with SConscript file
         if 'SConscript' in filenames:
             yield rel_path
+
+class ModuleDirsIndex(object):
+    """Persistent, incremental index of module directories.
+
+    For every visited directory, the index records the directory mtime,
+     along with the parts of its listing that matter for module discovery
+     (sub-directories, SConscript file, skip-marker files).
+    Adding, removing or renaming a directory entry updates the mtime of
+     that directory, so a directory with an unchanged mtime reuses its
+     recorded listing, and only changed directories are listed again.
+    """
+
+    # Bump when the format of the stored records changes
+    _version = 1
+
+    def __init__(self, index_path, max_depth=None, followlinks=False,
+                 dir_skip_list=None, file_skip_list=None, index_key=None):
+        """Initialize module directories index (see module_dirs_generator).
+
+        @param index_path       Path of the persistent index file
+        @param index_key        Extra value that invalidates the index
+        """
+        self._index_path = index_path
+        self._max_depth = int(max_depth) if max_depth else None
+        self._followlinks = followlinks
+        self._dir_skip_list = listify(dir_skip_list)
+        self._skip_markers = set(listify(file_skip_list))
+        self._signature = (self._version, self._max_depth, followlinks,
+                           sorted(self._skip_markers), index_key)
+        # Directory records from previous run (path -> record)
+        self._old_dirs = self._load()
+        # Directory records for current run (path -> record)
+        self._dirs = dict()
+        self._dirty = False
+        # Directories modified this recently can't be trusted next time,
+        #  because another change within the same mtime tick goes unnoticed.
+        self._racy_mtime = time.time() - 2
+
+    def module_dirs(self):
+        """Generate module directories (relative to current directory),
+        in the same order as the os.walk-based generator.
+        """
+        for module_dir in self._visit('', 0):
+            yield module_dir
+        if self._dirty or set(self._old_dirs) != set(self._dirs):
+            self._save()
+
+    def _visit(self, rel_path, depth):
+        """Generate module directories in `rel_path` and below."""
+        if rel_path:
+            for skip_dir_func in self._dir_skip_list:
+                # Skip skip-list directories
+                if skip_dir_func(rel_path):
+                    return
+        subdirs, has_sconscript, has_marker = self._get_record(rel_path)
+        if rel_path and has_marker:
+            # Skip directories with skip-list files (except the top dir)
+            sprint('|- Skipping %s (skip marker found)', rel_path)
+            return
+        if has_sconscript:
+            yield rel_path
+        if self._max_depth and depth >= self._max_depth:
+            # prevent recursing deeper
+            return
+        for subdir in subdirs:
+            for module_dir in self._visit(os.path.join(rel_path, subdir),
+                                          depth + 1):
+                yield module_dir
+
+    def _get_record(self, rel_path):
+        """Return (subdirs, has_sconscript, has_marker) for `rel_path`.
+
+        The recorded listing is reused if the directory mtime didn't change,
+         otherwise the directory is listed again.
+        """
+        dirpath = rel_path or '.'
+        try:
+            mtime = os.stat(dirpath).st_mtime
+        except OSError:
+            mtime = None
+        old_record = self._old_dirs.get(rel_path)
+        if mtime is not None and old_record and old_record[0] == mtime:
+            record = old_record
+        else:
+            record = (mtime if mtime < self._racy_mtime else None,
+                      ) + self._list_dir(dirpath)
+            self._dirty = True
+        self._dirs[rel_path] = record
+        return record[1:]
+
+    def _list_dir(self, dirpath):
+        """Return (subdirs, has_sconscript, has_marker) by listing `dirpath`."""
+        try:
+            names = os.listdir(dirpath)
+        except OSError:
+            return (), False, False
+        subdirs = list()
+        for name in names:
+            path = os.path.join(dirpath, name)
+            if os.path.isdir(path) and (self._followlinks or
+                                        not os.path.islink(path)):
+                subdirs.append(name)
+        return (tuple(subdirs), 'SConscript' in names,
+                bool(self._skip_markers.intersection(names)))
+
+    def _load(self):
+        """Return directory records from the persistent index file."""
+        try:
+            with open(self._index_path, 'rb') as index_file:
+                signature, dirs = pickle.load(index_file)
+        except (IOError, EOFError, ValueError, TypeError,
+                pickle.UnpicklingError):
+            return dict()
+        if signature != self._signature:
+            return dict()
+        return dirs
+
+    def _save(self):
+        """Atomically write the directory records to the index file."""
+        index_dir = os.path.dirname(self._index_path)
+        try:
+            if index_dir and not os.path.isdir(index_dir):
+                os.makedirs(index_dir)
+            tmp_path = '%s.%d' % (self._index_path, os.getpid())
+            with open(tmp_path, 'wb') as index_file:
+                pickle.dump((self._signature, self._dirs), index_file,
+                            pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self._index_path)
+        except (IOError, OSError):
+            sprint('|- Failed writing module index %s', self._index_path)
+
+class ModuleManifest(object):
+    """Persistent manifest of the targets declared by every module.
+
+    For every module, the manifest records the state (mtime & size) of its
+     SConscript file, along with a summary of the shortcut calls it makes,
+     as (shortcut name, target name, with_libs queries) entries.
+    A module with an unchanged SConscript reuses its recorded entries, so
+     the modules needed for a target can be found without reading every
+     module SConscript.
+    """
+
+    # Bump when the format of the stored entries changes
+    _version = 1
+
+    def __init__(self, manifest_path, key_sep='::'):
+        """Initialize module manifest.
+
+        @param manifest_path    Path of the persistent manifest file
+        @param key_sep          Separator between module and library name
+                                in library keys
+        """
+        self._manifest_path = manifest_path
+        self._key_sep = key_sep
+        # Module records from previous run (module -> (state, entries))
+        self._old_modules = self._load()
+        # Module records for current run (module -> (state, entries))
+        self._modules = dict()
+        self._dirty = False
+        # SConscripts modified this recently can't be trusted next time
+        self._racy_mtime = time.time() - 2
+
+    def get(self, module):
+        """Return recorded entries of module (None if missing or stale)."""
+        state = self._sconscript_state(module)
+        old_record = self._old_modules.get(module)
+        if state is None or not old_record or old_record[0] != state:
+            return None
+        self._modules[module] = old_record
+        return old_record[1]
+
+    def set(self, module, entries):
+        """Record entries of module (from reading its SConscript)."""
+        state = self._sconscript_state(module)
+        if state and state[0] >= self._racy_mtime:
+            state = None
+        self._modules[module] = (state, list(entries))
+        self._dirty = True
+
+    def entries(self, module):
+        """Return entries of module (that was `get` or `set` in this run)."""
+        return self._modules[module][1]
+
+    def closure(self, modules):
+        """Return set of `modules` and every module they depend on.
+
+        Module A depends on module B if an entry of A has a `with_libs`
+         query that matches a library of B (like LibraryRegistry.match,
+         with module and target names converted to keys by `path_to_key`).
+        """
+        module_by_key = dict()
+        modules_by_lib = defaultdict(set)
+        for module, (_, entries) in self._modules.iteritems():
+            module_by_key[path_to_key(module)] = module
+            for _, target_name, _ in entries:
+                if target_name:
+                    modules_by_lib[path_to_key(target_name)].add(module)
+        result = set()
+        queue = list(modules)
+        while queue:
+            module = queue.pop()
+            if module in result:
+                continue
+            result.add(module)
+            for _, _, with_libs in self.entries(module):
+                for lib_query in with_libs:
+                    if self._key_sep in lib_query:
+                        module_key = path_to_key(
+                            lib_query.rsplit(self._key_sep, 1)[0])
+                        if module_key in module_by_key:
+                            queue.append(module_by_key[module_key])
+                    else:
+                        queue.extend(modules_by_lib.get(
+                            path_to_key(lib_query), ()))
+        return result
+
+    def save(self):
+        """Atomically write module records to the manifest file (if needed).
+
+        Only modules that were accessed in this run are kept.
+        """
+        if not self._dirty and set(self._old_modules) == set(self._modules):
+            return
+        manifest_dir = os.path.dirname(self._manifest_path)
+        try:
+            if manifest_dir and not os.path.isdir(manifest_dir):
+                os.makedirs(manifest_dir)
+            tmp_path = '%s.%d' % (self._manifest_path, os.getpid())
+            with open(tmp_path, 'wb') as manifest_file:
+                pickle.dump((self._version, self._modules), manifest_file,
+                            pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self._manifest_path)
+        except (IOError, OSError):
+            sprint('|- Failed writing module manifest %s',
+                   self._manifest_path)
+
+    @staticmethod
+    def _sconscript_state(module):
+        """Return (mtime, size) of module SConscript (None if missing)."""
+        try:
+            stat = os.stat(os.path.join(module, 'SConscript'))
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size)
+
+    def _load(self):
+        """Return module records from the persistent manifest file."""
+        try:
+            with open(self._manifest_path, 'rb') as manifest_file:
+                version, modules = pickle.load(manifest_file)
+        except (IOError, EOFError, ValueError, TypeError,
+                pickle.UnpicklingError):
+            return dict()
+        if version != self._version:
+            return dict()
+        return modules
+
+class LibraryRegistry(object):
+    """Registry of library targets with their library dependencies.
+
+    Libraries are registered by key ("Module::LibName"), and indexed by their
+     short name ("LibName"), so queries don't need to scan every key.
+    Each library may depend on other libraries (by query), and the registry
+     provides the transitive closure of dependencies in link order.
+    """
+
+    def __init__(self, key_sep='::'):
+        """Initialize an empty library registry.
+
+        @param key_sep      Separator between module and library name in keys
+        """
+        self._key_sep = key_sep
+        # Library key -> library nodes
+        self._libs = dict()
+        # Library key -> list of library dependency queries
+        self._deps = dict()
+        # Library short name -> list of library keys
+        self._keys_by_name = defaultdict(list)
+        # Library key -> cached transitive closure (dependencies first)
+        self._closures = dict()
+
+    def __contains__(self, lib_key):
+        return lib_key in self._libs
+
+    def __getitem__(self, lib_key):
+        return self._libs[lib_key]
+
+    def __len__(self):
+        return len(self._libs)
+
+    def add(self, lib_key, lib_nodes, with_libs=None):
+        """Register library nodes under `lib_key`.
+
+        @param lib_key      Unique library key ("Module::LibName")
+        @param lib_nodes    Library nodes to link with
+        @param with_libs    Library query (or list of queries) this library
+                            depends on (resolved lazily, on first use)
+        """
+        assert lib_key not in self._libs
+        self._libs[lib_key] = lib_nodes
+        self._deps[lib_key] = listify(with_libs)
+        short_name = lib_key.rsplit(self._key_sep, 1)[-1]
+        self._keys_by_name[short_name].append(lib_key)
+        # New library may affect resolution of cached closures
+        self._closures.clear()
+
+    def match(self, lib_query):
+        """Return list of library keys for given library name query.
+
+        A "library query" is either a fully-qualified "Module::LibName" string
+         or just a "LibName".
+        If just "LibName" form, return all matches from all modules.
+        """
+        if self._key_sep in lib_query:
+            # It's a fully-qualified "Module::LibName" query
+            return [lib_query] if lib_query in self._libs else []
+        # It's a target-name-only query. Look up the short name index.
+        return list(self._keys_by_name.get(lib_query, []))
+
+    def resolve(self, lib_query):
+        """Return the single library key that matches `lib_query`.
+
+        Raise StopError if the query matches no library, or more than one.
+        """
+        lib_keys = self.match(lib_query)
+        if len(lib_keys) == 1:
+            # Matched internal library
+            return lib_keys[0]
+        if len(lib_keys) > 1:
+            # Matched multiple internal libraries - probably bad!
+            raise StopError('Library identifier "%s" matched %d '
+                            'libraries (%s). Please use a fully '
+                            'qualified identifier instead!' %
+                            (lib_query, len(lib_keys), ', '.join(lib_keys)))
+        # empty lib_keys
+        raise StopError('Library identifier "%s" didn\'t match '
+                        'any library. Is it a typo?' % (lib_query))
+
+    def link_order(self, lib_queries):
+        """Return library keys to link with for given library queries.
+
+        The result includes the queried libraries and all of their
+         (transitive) dependencies, ordered such that every library comes
+         before the libraries it depends on (as static linking requires).
+        """
+        result = list()
+        seen = set()
+        # Merge dependencies-first closures, processing queries in reverse,
+        #  so reversing the result keeps queried libraries in given order.
+        for lib_query in reversed(listify(lib_queries)):
+            for lib_key in self.closure(self.resolve(lib_query)):
+                if lib_key not in seen:
+                    seen.add(lib_key)
+                    result.append(lib_key)
+        result.reverse()
+        return result
+
+    def closure(self, lib_key):
+        """Return transitive closure of `lib_key` (dependencies first).
+
+        The closure is a tuple of library keys that ends with `lib_key`,
+         where every library comes after all of its dependencies.
+        Closures are cached per library.
+        Raise StopError if a dependency cycle is detected.
+        """
+        if lib_key in self._closures:
+            return self._closures[lib_key]
+        # Iterative depth-first traversal, to support deep dependency chains
+        stack = [(lib_key, iter(self._dep_keys(lib_key)))]
+        on_stack = set([lib_key])
+        while stack:
+            cur_key, deps_iter = stack[-1]
+            for dep_key in deps_iter:
+                if dep_key in self._closures:
+                    continue
+                if dep_key in on_stack:
+                    cycle = [key for key, _ in stack]
+                    cycle = cycle[cycle.index(dep_key):] + [dep_key]
+                    raise StopError('Library dependency cycle detected: %s' %
+                                    (' -> '.join(cycle)))
+                stack.append((dep_key, iter(self._dep_keys(dep_key))))
+                on_stack.add(dep_key)
+                break
+            else:
+                # All dependencies of current library have closures
+                stack.pop()
+                on_stack.discard(cur_key)
+                closure = list()
+                seen = set()
+                for dep_key in self._dep_keys(cur_key):
+                    for key in self._closures[dep_key]:
+                        if key not in seen:
+                            seen.add(key)
+                            closure.append(key)
+                closure.append(cur_key)
+                self._closures[cur_key] = tuple(closure)
+        return self._closures[lib_key]
+
+    def _dep_keys(self, lib_key):
+        """Return list of library keys that `lib_key` directly depends on."""
+        return [self.resolve(lib_query) for lib_query in self._deps[lib_key]]
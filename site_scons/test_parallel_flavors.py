@@ -0,0 +1,137 @@
+# Copyright 2015 The Ostrich / by Itamar O
+
+"""Unit tests for parallel_flavors.
+
+usage: python -m unittest discover -s site_scons -p 'test_*.py'
+
+Tests that use the SCons signatures database need the SCons engine in
+PYTHONPATH, and the end-to-end test runs the SCons command in $SCONS
+(default: `scons`), building a generated benchmark project (see
+benchmarks/generate_project.py) with the stub toolchain.
+"""
+
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+try:
+    import SCons.dblite
+    import SCons.SConsign
+except ImportError:
+    SCons = None
+
+from parallel_flavors import (flavor_args, flavor_sconsign, merge_sconsigns,
+                              seed_sconsigns)
+
+_BENCHMARKS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               os.pardir, 'benchmarks')
+
+def _which(program):
+    """Return True if program is found in PATH (or is a path to a file)."""
+    if os.path.dirname(program):
+        return os.path.isfile(program)
+    return any(os.access(os.path.join(path_dir, program), os.X_OK)
+               for path_dir in os.environ.get('PATH', '').split(os.pathsep))
+
+class FlavorArgsTest(unittest.TestCase):
+    """Tests for flavor process command line arguments."""
+
+    def test_flavor_args(self):
+        """Jobs, directory options and other flavor targets are removed."""
+        self.assertEqual(
+            ['--debug=explain', 'debug', '-j', '2'],
+            flavor_args(['-j', '8', '-C', 'proj', '--parallel-flavors',
+                         '--debug=explain', 'debug', 'release'],
+                        'debug', ['debug', 'release'], 2))
+        self.assertEqual(
+            ['-k', '-j', '3'],
+            flavor_args(['-j8', '-Cproj', '--directory=proj', '-u', '-U',
+                         '-D', '--search-up', '-k', 'debug'],
+                        None, ['debug', 'release'], 3))
+
+@unittest.skipUnless(SCons, 'SCons engine not in PYTHONPATH')
+class MergeSconsignsTest(unittest.TestCase):
+    """Tests for seeding and merging flavor signatures databases."""
+
+    def setUp(self):
+        self.orig_dir = os.getcwd()
+        self.tmp_dir = tempfile.mkdtemp()
+        os.chdir(self.tmp_dir)
+
+    def tearDown(self):
+        os.chdir(self.orig_dir)
+        shutil.rmtree(self.tmp_dir)
+
+    @staticmethod
+    def _write_db(name, entries):
+        """Write entries to signatures database `name`."""
+        sig_db = SCons.dblite.open(name, 'c')
+        for key, value in entries.iteritems():
+            sig_db[key] = value
+        sig_db.sync()
+
+    def test_merge_changed_entries(self):
+        """Seeded entries of other flavors don't override fresh entries."""
+        self._write_db(SCons.SConsign.DB_Name, {
+            'build/debug/Reader': 'debug-old',
+            'build/release/Reader': 'release-old',
+            'Reader': 'source'})
+        seed_sconsigns(['debug', 'release'])
+        self._write_db(flavor_sconsign('debug'),
+                       {'build/debug/Reader': 'debug-new'})
+        self._write_db(flavor_sconsign('release'),
+                       {'build/release/Reader': 'release-new'})
+        merge_sconsigns(['debug', 'release'])
+        main_db = SCons.dblite.open(SCons.SConsign.DB_Name, 'r')
+        self.assertEqual('debug-new', main_db['build/debug/Reader'])
+        self.assertEqual('release-new', main_db['build/release/Reader'])
+        self.assertEqual('source', main_db['Reader'])
+
+@unittest.skipUnless(_which(os.environ.get('SCONS', 'scons')),
+                     'SCons command not found (set $SCONS)')
+class SerialAfterParallelTest(unittest.TestCase):
+    """End-to-end test of switching from parallel to serial flavor builds."""
+
+    def setUp(self):
+        sys.path.insert(0, _BENCHMARKS_DIR)
+        import generate_project  # pylint: disable=import-error
+        sys.path.remove(_BENCHMARKS_DIR)
+        parser = optparse.OptionParser()
+        generate_project.add_options(parser)
+        opts, _ = parser.parse_args(['--modules=4', '--depth=1'])
+        self.tmp_dir = tempfile.mkdtemp()
+        self.project_dir = os.path.join(self.tmp_dir, 'project')
+        generate_project.generate_project(self.project_dir, opts)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _scons(self, *args):
+        """Run SCons in the project dir, return its output."""
+        env = dict(os.environ)
+        env.pop('BUILD_FLAVOR', None)
+        proc = subprocess.Popen(
+            [os.environ.get('SCONS', 'scons')] + list(args),
+            cwd=self.project_dir, env=env, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+        self.assertEqual(0, proc.returncode, output)
+        return output
+
+    def test_serial_build_after_parallel_build(self):
+        """Serial build after a parallel flavors build is a null build."""
+        self._scons('-j', '4', '--parallel-flavors')
+        source = os.path.join(self.project_dir, 'm1', 'm1_s0.cc')
+        self.assertTrue(os.path.isfile(source))
+        with open(source, 'a') as source_file:
+            source_file.write('// edit\n')
+        self._scons('-j', '4', '--parallel-flavors')
+        output = self._scons('--debug=explain')
+        self.assertNotIn('because', output)
+
+if '__main__' == __name__:
+    unittest.main()
@@ -0,0 +1,185 @@
+# Copyright 2015 The Ostrich / by Itamar O
+
+"""Unit tests for site_utils.
+
+usage: python -m unittest discover -s site_scons -p 'test_*.py'
+"""
+
+import unittest
+
+import os
+import shutil
+import tempfile
+
+from site_utils import (LibraryRegistry, ModuleManifest, StopError,
+                        module_dirs_generator)
+
+class LibraryRegistryTest(unittest.TestCase):
+    """Tests for LibraryRegistry."""
+
+    def setUp(self):
+        """Register libraries in a small dependency graph:
+
+        App::app -> Net::net -> Base::base
+                 -> Util::util -> Base::base
+        Net::base and Base::base share a short name.
+        """
+        self.registry = LibraryRegistry()
+        self.registry.add('Base::base', ['libbase.a'])
+        self.registry.add('Util::util', ['libutil.a'], 'Base::base')
+        self.registry.add('Net::net', ['libnet.a'], ['Base::base'])
+        self.registry.add('App::app', ['libapp.a'], ['net', 'util'])
+        self.registry.add('Net::base', ['libnetbase.a'])
+
+    def test_match(self):
+        """Short name and fully-qualified queries match library keys."""
+        self.assertEqual(['Util::util'], self.registry.match('util'))
+        self.assertEqual(['Util::util'], self.registry.match('Util::util'))
+        self.assertEqual(['Base::base', 'Net::base'],
+                         sorted(self.registry.match('base')))
+        self.assertEqual([], self.registry.match('nosuchlib'))
+        self.assertEqual([], self.registry.match('Util::nosuchlib'))
+
+    def test_resolve(self):
+        """Queries resolve to a single library key."""
+        self.assertEqual('Net::net', self.registry.resolve('net'))
+        self.assertEqual('Net::base', self.registry.resolve('Net::base'))
+
+    def test_resolve_ambiguous(self):
+        """Query that matches several libraries is an error."""
+        self.assertRaises(StopError, self.registry.resolve, 'base')
+
+    def test_resolve_missing(self):
+        """Query that matches no library is an error."""
+        self.assertRaises(StopError, self.registry.resolve, 'nosuchlib')
+
+    def test_closure(self):
+        """Closure lists every dependency before the libraries using it."""
+        self.assertEqual(('Base::base',),
+                         self.registry.closure('Base::base'))
+        closure = self.registry.closure('App::app')
+        self.assertEqual('App::app', closure[-1])
+        self.assertEqual(set(['App::app', 'Net::net', 'Util::util',
+                              'Base::base']), set(closure))
+        self.assertEqual(4, len(closure))
+        self.assertLess(closure.index('Base::base'),
+                        closure.index('Net::net'))
+        self.assertLess(closure.index('Base::base'),
+                        closure.index('Util::util'))
+
+    def test_link_order(self):
+        """Link order puts every library before its dependencies."""
+        order = self.registry.link_order('app')
+        self.assertEqual(['App::app', 'Base::base'], [order[0], order[-1]])
+        self.assertEqual(set(['Net::net', 'Util::util']), set(order[1:3]))
+        self.assertEqual(['Util::util', 'Net::net', 'Base::base'],
+                         self.registry.link_order(['util', 'net']))
+        self.assertEqual([], self.registry.link_order(None))
+
+    def test_link_order_after_add(self):
+        """Libraries added later are resolved in cached closures."""
+        self.registry.link_order('app')
+        self.registry.add('Log::log', ['liblog.a'], 'Base::base')
+        self.assertEqual(['Log::log', 'Base::base'],
+                         self.registry.link_order('log'))
+
+    def test_closure_cycle(self):
+        """Dependency cycle is an error that names the cycle."""
+        self.registry.add('Cycle::a', ['liba.a'], 'Cycle::b')
+        self.registry.add('Cycle::b', ['libb.a'], 'Cycle::c')
+        self.registry.add('Cycle::c', ['libc.a'], 'Cycle::a')
+        try:
+            self.registry.closure('Cycle::a')
+        except StopError as exc:
+            self.assertIn('Cycle::a -> Cycle::b -> Cycle::c -> Cycle::a',
+                          str(exc))
+        else:
+            self.fail('Dependency cycle not detected')
+
+    def test_link_order_cycle(self):
+        """Link order of a library in a cycle is an error."""
+        self.registry.add('Cycle::a', ['liba.a'], 'Cycle::a')
+        self.assertRaises(StopError, self.registry.link_order, 'Cycle::a')
+
+class ModuleManifestTest(unittest.TestCase):
+    """Tests for ModuleManifest.closure."""
+
+    def setUp(self):
+        """Record entries of modules in a nested module dir:
+
+        Apps/writer -> Lib::io.file (query of a nested target name)
+        Apps/reader -> io.file (short query of the nested target name)
+        Lib         -> Base.util::util (query of a nested module)
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.manifest = ModuleManifest(os.path.join(self.tmp_dir, 'manifest'))
+        self.manifest.set('Apps/writer', [('Prog', 'writer', ['Lib::io.file'])])
+        self.manifest.set('Apps/reader', [('Prog', 'reader', ['io.file'])])
+        self.manifest.set('Lib', [('Lib', 'io/file', ['Base.util::util'])])
+        self.manifest.set('Base/util', [('Lib', 'util', [])])
+        self.manifest.set('Other', [('Lib', 'other', [])])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_closure_nested_target(self):
+        """Short queries match target names converted to keys."""
+        self.assertEqual(set(['Apps/reader', 'Lib', 'Base/util']),
+                         self.manifest.closure(['Apps/reader']))
+
+    def test_closure_qualified_query(self):
+        """Fully-qualified queries match modules by key."""
+        self.assertEqual(set(['Apps/writer', 'Lib', 'Base/util']),
+                         self.manifest.closure(['Apps/writer']))
+
+class ModuleDirsIndexTest(unittest.TestCase):
+    """Tests for the persistent module dirs index (vs walking the tree)."""
+
+    def setUp(self):
+        """Create a tree of module dirs, with skip markers (in the top dir
+        too) and a skip-list dir:
+
+        SConscript, .noscons
+        App/SConscript
+        App/sub/SConscript
+        Lib/deep/SConscript
+        Skipped/.noscons, Skipped/SConscript
+        build/SConscript
+        """
+        self.orig_dir = os.getcwd()
+        self.tmp_dir = tempfile.mkdtemp()
+        os.chdir(self.tmp_dir)
+        self.index_path = os.path.join(self.tmp_dir, '.modules_index')
+        for path in ('SConscript', '.noscons', 'App/SConscript',
+                     'App/sub/SConscript', 'Lib/deep/SConscript',
+                     'Skipped/.noscons', 'Skipped/SConscript',
+                     'build/SConscript'):
+            if os.path.dirname(path) and not os.path.isdir(
+                    os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+
+    def tearDown(self):
+        os.chdir(self.orig_dir)
+        shutil.rmtree(self.tmp_dir)
+
+    def _module_dirs(self, max_depth, index_path=None):
+        """Return module dirs found by the generator."""
+        return list(module_dirs_generator(
+            max_depth=max_depth, dir_skip_list=[lambda d: d == 'build'],
+            file_skip_list=['.noscons'], index_path=index_path))
+
+    def test_index_matches_walk(self):
+        """The index finds the same module dirs as walking the tree,
+        when it's created and when it's reused."""
+        for max_depth in (None, 1):
+            walked = self._module_dirs(max_depth)
+            self.assertIn('', walked)
+            self.assertIn('App', walked)
+            self.assertNotIn('Skipped', walked)
+            for _ in xrange(2):
+                self.assertEqual(walked, self._module_dirs(max_depth,
+                                                           self.index_path))
+
+if '__main__' == __name__:
+    unittest.main()